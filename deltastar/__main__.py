@@ -0,0 +1,8 @@
+# -*- coding: utf8 -*-
+
+# lets the command line tool run as `python -m deltastar`
+
+import sys
+from deltastar.cli import main
+
+sys.exit(main())
@@ -0,0 +1,248 @@
+# -*- coding: utf8 -*-
+
+# benchmark suite for compile time, rewrite throughput and memory scaling.
+#
+# every scenario generates a synthetic grammar and corpus from a fixed seed, so results are comparable between runs.
+#
+# usage:
+#   python bench.py                                   run every scenario and print the results
+#   python bench.py -o results.json                   also write the results to a file
+#   python bench.py --save-baseline baseline.json     store the results as the baseline
+#   python bench.py --baseline baseline.json          compare against a baseline (exit code 1 on regressions)
+#   python bench.py --scenario contexts_100 --quick   run a subset with fewer repeats
+#
+# every run also checks that rewrite_many is faster than rewriting the strings one by one (exit code 1 otherwise)
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass, asdict
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+from tables import MIN_LANES
+from transducers import assimilation, deletion, insertion
+from version import __version__
+
+# metrics where a larger value is better. Every other compared metric is a duration or a memory size
+HIGHER_IS_BETTER = {"rewrite_symbols_per_sec", "rewrite_many_symbols_per_sec"}
+COMPARED = ["compile_seconds", "compile_peak_bytes", "rewrite_symbols_per_sec", "rewrite_many_symbols_per_sec", "rewrite_peak_bytes"]
+
+# every timing measurement repeats its function for at least this many seconds
+MIN_SECONDS = 0.1
+
+
+@dataclass
+class Scenario:
+
+    name:str
+    rule_type:str = "assimilation"
+    context_type:str = "left"   # left, right or dual
+    num_contexts:int = 10
+    context_length:int = 3
+    num_mappings:int = 2
+    alphabet_size:int = 12
+    input_length:int = 20       # symbols per input string
+    num_strings:int = 2000
+    seed:int = 0
+
+
+SCENARIOS = [
+    Scenario("baseline"),
+    Scenario("contexts_100", num_contexts=100),
+    Scenario("contexts_400", num_contexts=400),
+    Scenario("context_length_8", context_length=8),
+    Scenario("mappings_10", num_mappings=10, alphabet_size=20),
+    Scenario("alphabet_60", alphabet_size=60),
+    Scenario("right_contexts", context_type="right", num_contexts=50),
+    Scenario("dual_contexts", context_type="dual", num_contexts=50),
+    Scenario("deletion", rule_type="deletion", num_contexts=50),
+    Scenario("insertion", rule_type="insertion", num_contexts=20, num_mappings=1),
+    Scenario("long_inputs", input_length=2000, num_strings=50),
+]
+
+
+def alphabet(size):
+    """Single characters first, then [tags] once the letters run out"""
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return [letters[i] if i < len(letters) else f"[t{i}]" for i in range(size)]
+
+
+def generate_grammar(scenario:Scenario):
+    """Returns the (pairs, contexts) of a synthetic rule"""
+    rng = random.Random(scenario.seed)
+    symbols = alphabet(scenario.alphabet_size)
+
+    mapped = rng.sample(symbols, min(scenario.num_mappings, len(symbols)))
+    if scenario.rule_type == "assimilation":
+        pairs = [(sym, rng.choice(symbols)) for sym in mapped]
+    elif scenario.rule_type == "deletion":
+        pairs = [(sym, "") for sym in mapped]
+    else:
+        pairs = [("", mapped[0])]
+
+    contexts = set()
+    while len(contexts) < scenario.num_contexts:
+        side = lambda: " ".join(rng.choice(symbols) for _ in range(scenario.context_length))
+        if scenario.context_type == "left":
+            contexts.add(f"{side()} _")
+        elif scenario.context_type == "right":
+            contexts.add(f"_ {side()}")
+        else:
+            contexts.add(f"{side()} _ {side()}")
+    return pairs, sorted(contexts)
+
+
+def generate_corpus(scenario:Scenario):
+    rng = random.Random(scenario.seed + 1)
+    symbols = alphabet(scenario.alphabet_size)
+    return [" ".join(rng.choice(symbols) for _ in range(scenario.input_length)) for _ in range(scenario.num_strings)]
+
+
+def peak_memory(func):
+    """Runs func and returns its result and the peak memory (in bytes) it allocated"""
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def best_time(func, repeats, min_seconds=MIN_SECONDS):
+    """Shortest wall time of a call to func over repeats measurements (the least noisy estimate). Each measurement calls func
+    until at least min_seconds have passed and averages over the calls, so that fast scenarios aren't compared on timer noise"""
+    best = float("inf")
+    for _ in range(repeats):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            result = func()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_seconds:
+                break
+        best = min(best, elapsed / calls)
+    return result, best
+
+
+def run_scenario(scenario:Scenario, repeats=3):
+    factory = {"assimilation": assimilation, "deletion": deletion, "insertion": insertion}[scenario.rule_type]
+    pairs, contexts = generate_grammar(scenario)
+    corpus = generate_corpus(scenario)
+    num_symbols = sum(len(s.split()) for s in corpus)
+
+    fst, compile_seconds = best_time(lambda: factory(pairs, contexts), repeats)
+    _, compile_peak = peak_memory(lambda: factory(pairs, contexts))
+
+    _, rewrite_seconds = best_time(lambda: [fst.rewrite(s) for s in corpus], repeats)
+    _, rewrite_many_seconds = best_time(lambda: fst.rewrite_many(corpus), repeats)
+    _, rewrite_peak = peak_memory(lambda: fst.rewrite_many(corpus))
+
+    return {
+        "scenario": asdict(scenario),
+        "states": len(fst.table.states),
+        "edges": fst.table.num_edges,
+        "compile_seconds": compile_seconds,
+        "compile_phases": fst.compile_times,
+        "compile_peak_bytes": compile_peak,
+        "rewrite_symbols_per_sec": num_symbols / rewrite_seconds,
+        "rewrite_many_symbols_per_sec": num_symbols / rewrite_many_seconds,
+        "rewrite_peak_bytes": rewrite_peak,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Returns a list of (scenario, metric, baseline value, new value, relative change) for every regression beyond threshold"""
+    regressions = []
+    for name, metrics in results.items():
+        if name not in baseline:
+            continue
+        for metric in COMPARED:
+            old, new = baseline[name][metric], metrics[metric]
+            if not old:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            if worse > threshold:
+                regressions.append((name, metric, old, new, change))
+    return regressions
+
+
+def slower_batches(results):
+    """Returns a list of (scenario, rewrite sym/s, rewrite_many sym/s) for every scenario where rewrite_many lost to the rewrite loop.
+    Scenarios with fewer than MIN_LANES strings are skipped, since rewrite_many rewrites those one by one too"""
+    return [(name, metrics["rewrite_symbols_per_sec"], metrics["rewrite_many_symbols_per_sec"])
+            for name, metrics in results.items()
+            if metrics["scenario"]["num_strings"] >= MIN_LANES
+            and metrics["rewrite_many_symbols_per_sec"] <= metrics["rewrite_symbols_per_sec"]]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="deltastar benchmarks")
+    parser.add_argument("--scenario", action="append", help="scenario to run (repeatable). Defaults to all of them")
+    parser.add_argument("--quick", action="store_true", help="run every measurement once")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON file of previous results to compare against")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed relative slowdown before a metric counts as a regression")
+    args = parser.parse_args(argv)
+
+    scenarios = SCENARIOS
+    if args.scenario:
+        known = {s.name:s for s in SCENARIOS}
+        unknown = [name for name in args.scenario if name not in known]
+        if unknown:
+            parser.error(f"unknown scenarios: {', '.join(unknown)}")
+        scenarios = [known[name] for name in args.scenario]
+
+    results = {}
+    for scenario in scenarios:
+        results[scenario.name] = metrics = run_scenario(scenario, repeats=1 if args.quick else 3)
+        print(f"{scenario.name:<20} states={metrics['states']:<6} compile={metrics['compile_seconds']:.3f}s "
+              f"rewrite={metrics['rewrite_symbols_per_sec']:,.0f} sym/s "
+              f"rewrite_many={metrics['rewrite_many_symbols_per_sec']:,.0f} sym/s "
+              f"peak={metrics['compile_peak_bytes'] / 2**20:.1f}MiB")
+
+    report = {
+        "meta": {
+            "deltastar": __version__,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf8") as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+
+    failed = False
+    for name, loop, batch in slower_batches(results):
+        print(f"SLOWER BATCH {name}: rewrite_many {batch:,.0f} sym/s <= rewrite {loop:,.0f} sym/s")
+        failed = True
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf8") as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        for name, metric, old, new, change in regressions:
+            print(f"REGRESSION {name}.{metric}: {old:,.4g} -> {new:,.4g} ({change:+.1%})")
+        if regressions:
+            failed = True
+        else:
+            print(f"no regressions beyond {args.threshold:.0%}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,164 @@
+# -*- coding: utf8 -*-
+
+# this file contains the in-memory result cache used by DFST.rewrite
+# and the on-disk compilation cache used by DFST.from_rules
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+from collections import OrderedDict
+from version import __version__
+
+
+class RewriteCache:
+    """Bounded least-recently-used cache mapping input strings to their rewrites"""
+
+    def __init__(self, maxsize=100_000):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"RewriteCache({self.info})"
+
+    @property
+    def info(self):
+        """Dictionary of the cache's size and hit, miss and eviction counters"""
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def get(self, key):
+        """Returns the cached rewrite of key (marking it as recently used), or None on a miss"""
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Empties the cache and resets its counters"""
+        self._data.clear()
+        self.hits = self.misses = self.evictions = 0
+
+
+
+class CompileCache:
+    """Directory of compiled machines addressed by a hash of the rules they were compiled from.
+    Entries older than max_age are evicted, then the least recently used ones until the directory fits in max_bytes"""
+
+    SUFFIX = ".dfst.pkl"
+
+    def __init__(self, directory, max_bytes=512 * 2**20, max_age=30 * 24 * 60 * 60):
+        self.directory = os.fspath(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __repr__(self):
+        return f"CompileCache({self.directory!r})"
+
+    @staticmethod
+    def key(insyms, outsyms, contexts, rule_type) -> str:
+        """Stable hash of a rule set. Contexts are whitespace normalized, and the library version is included
+        so that upgrading deltastar never returns machines built by older code"""
+        spec = {
+            "insyms": list(insyms),
+            "outsyms": list(outsyms),
+            "contexts": [" ".join(con.split()) for con in contexts],
+            "rule_type": rule_type,
+            "version": __version__,
+        }
+        return hashlib.sha256(json.dumps(spec, ensure_ascii=False, sort_keys=True).encode("utf8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def get(self, key):
+        """Returns the machine stored under key, or None if there isn't one (or it can't be read)"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                machine = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            return None
+
+        try:
+            os.utime(path) # mark as recently used
+        except OSError:
+            pass
+        return machine
+
+    def put(self, key, machine):
+        """Stores a machine under key, then evicts stale entries"""
+
+        # write to a temporary file first so that concurrent readers never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(machine, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Removes entries older than max_age, then the least recently used entries until the cache fits in max_bytes
+
+        Returns:
+            int: number of removed entries
+        """
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort() # oldest first
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
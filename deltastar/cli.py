@@ -0,0 +1,280 @@
+# -*- coding: utf8 -*-
+
+# this file contains the deltastar command line tool.
+#
+# machines are given either as saved machines (DFST.save) or as JSON rule files. A rule file holds one machine
+# definition, or a list of them, or {"machines": [...]}. A definition looks like
+#   {"type": "assimilation", "pairs": [["t", "ɾ"], ["p", "b"]], "contexts": ["a _ a"], "v0": ""}
+# several machines are applied in order, as a cascade.
+#
+# usage:
+#   deltastar rewrite rules.json -i corpus.txt -o out.txt          rewrite a file, one string per line
+#   cat corpus.txt | deltastar rewrite voicing.dfst flapping.dfst  rewrite stdin through a cascade
+#   deltastar rewrite rules.json -i corpus.txt --workers 8 --chunk-size 4096 --stats-interval 5
+#   deltastar compile rules.json -o voicing.dfst                   compile once, load fast afterwards
+#   deltastar serve voicing.dfst flapping.dfst --port 8765         run a RewriteServer (see server.py)
+#
+# rewriting statistics (strings and tokens per second, per-chunk latency) are printed to stderr
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from pipeline import Pipeline
+from server import MAX_BATCH, MAX_WAIT, RewriteServer
+from server import load_machines
+from transducers import DFST, compile_many, compose
+from utils.funcs import ContextError, RuleError, StorageError
+from version import __version__
+
+# default number of lines sent to a worker at a time
+CHUNK_SIZE = 1024
+
+
+def load_rule_file(path:str, workers=1) -> list:
+    """Compiles every machine defined in a JSON rule file, in order (across worker processes if workers > 1)"""
+    with open(path, encoding="utf8") as f:
+        definitions = json.load(f)
+    if isinstance(definitions, dict):
+        definitions = definitions.get("machines", [definitions])
+    return [result.machine for result in compile_many(definitions, workers, raise_errors=True)]
+
+
+def saved_paths(paths:list, directory:str, workers=1) -> list:
+    """Paths of the saved machines to rewrite with, keeping their order. The machines of rule files (.json) are compiled
+    and saved to directory, so that every worker process can memory-map them instead of holding its own copy"""
+    saved = []
+    for path in paths:
+        if path.endswith(".json"):
+            for machine in load_rule_file(path, workers):
+                saved.append(os.path.join(directory, f"{len(saved)}.dfst"))
+                machine.save(saved[-1])
+        else:
+            saved.append(path)
+    return saved
+
+
+def rewriter(machines:list):
+    """The object lines are rewritten with: the machine itself, or a Pipeline for a cascade"""
+    return machines[0].compiled() if len(machines) == 1 else Pipeline(machines)
+
+
+
+class Stats:
+    """Running throughput and chunk latency counters, reported every interval seconds"""
+
+    def __init__(self, interval:float, stream=None):
+        self.interval = interval
+        self.stream = stream
+        self.start = self.last_report = time.perf_counter()
+        self.lines = self.tokens = 0
+        self.latencies = []
+        self._since = (0, 0)
+
+    def add(self, lines:int, tokens:int, latency:float):
+        self.lines += lines
+        self.tokens += tokens
+        self.latencies.append(latency)
+        if self.interval and time.perf_counter() - self.last_report >= self.interval:
+            self.report()
+
+    def summary(self, since=0.0, lines=0, tokens=0, latencies=None) -> dict:
+        """Strings and tokens per second since a point in time, and latency percentiles of chunks (in milliseconds)"""
+        elapsed = max(time.perf_counter() - since, 1e-9)
+        latencies = sorted(latencies if latencies is not None else self.latencies)
+
+        def percentile(p):
+            return 1000 * latencies[min(len(latencies)-1, int(p * len(latencies)))] if latencies else 0.0
+
+        return {
+            "lines": lines,
+            "tokens": tokens,
+            "seconds": elapsed,
+            "lines_per_sec": lines / elapsed,
+            "tokens_per_sec": tokens / elapsed,
+            "chunks": len(latencies),
+            "latency_ms_p50": percentile(0.5),
+            "latency_ms_p95": percentile(0.95),
+            "latency_ms_max": 1000 * latencies[-1] if latencies else 0.0,
+        }
+
+    def report(self):
+        """Prints the statistics of the chunks finished since the last report"""
+        lines, tokens = self._since
+        s = self.summary(self.last_report, self.lines - lines, self.tokens - tokens)
+        print(f"[deltastar] {self.lines} lines | {s['tokens_per_sec']:,.0f} tokens/s | {s['lines_per_sec']:,.0f} lines/s "
+              f"| chunk latency p50 {s['latency_ms_p50']:.1f} ms, p95 {s['latency_ms_p95']:.1f} ms, max {s['latency_ms_max']:.1f} ms",
+              file=self.stream or sys.stderr, flush=True)
+        self.last_report = time.perf_counter()
+        self._since = (self.lines, self.tokens)
+        self.latencies = []
+
+    def total(self) -> dict:
+        return self.summary(self.start, self.lines, self.tokens, [])
+
+
+
+def chunks(lines, size:int):
+    chunk = []
+    for line in lines:
+        chunk.append(line.rstrip("\n"))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# rewriter used by worker processes, loaded once per process by _init_worker
+_worker_rewriter = None
+
+def _init_worker(paths, mmap=True):
+    global _worker_rewriter
+    _worker_rewriter = rewriter([DFST.load(path, mmap=mmap) for path in paths])
+
+
+def _rewrite_chunk(chunk):
+    start = time.perf_counter()
+    outputs = _worker_rewriter.rewrite_many(chunk)
+    return outputs, time.perf_counter() - start
+
+
+def rewrite_chunks(paths, lines, workers=1, chunk_size=CHUNK_SIZE, mmap=True):
+    """Rewrites lines chunk by chunk through a cascade of saved machines, in order, with up to two chunks per worker in flight.
+    Every worker loads the machines itself, so memory-mapped machines are shared by all of them
+
+    Yields:
+        tuple[List[str], List[str], float]: input chunk, its rewrites, and the seconds spent rewriting it
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    if workers < 1:
+        raise ValueError("workers must be at least 1")
+
+    if workers == 1:
+        global _worker_rewriter
+        _init_worker(paths, mmap)
+        try:
+            for chunk in chunks(lines, chunk_size):
+                yield (chunk, *_rewrite_chunk(chunk))
+        finally:
+            _worker_rewriter = None # releases the memory-mapped files
+        return
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(paths, mmap)) as pool:
+        pending = deque()
+        for chunk in chunks(lines, chunk_size):
+            pending.append((chunk, pool.submit(_rewrite_chunk, chunk)))
+            if len(pending) >= 2 * workers:
+                chunk, future = pending.popleft()
+                yield (chunk, *future.result())
+        while pending:
+            chunk, future = pending.popleft()
+            yield (chunk, *future.result())
+
+
+
+def rewrite_command(args) -> int:
+    stats = Stats(args.stats_interval)
+    with tempfile.TemporaryDirectory() as directory:
+        paths = saved_paths(args.machines, directory, args.workers)
+
+        source = open(args.input, encoding=args.encoding) if args.input else sys.stdin
+        sink = open(args.output, "w", encoding=args.encoding, buffering=1<<20) if args.output else sys.stdout
+        try:
+            for chunk, outputs, seconds in rewrite_chunks(paths, source, args.workers, args.chunk_size, mmap=not args.no_mmap):
+                sink.write("".join(output + "\n" for output in outputs))
+                stats.add(len(chunk), sum(len(line.split()) for line in chunk), seconds)
+        finally:
+            if args.input:
+                source.close()
+            if args.output:
+                sink.close()
+            else:
+                sink.flush()
+
+    if args.stats_interval:
+        stats.report()
+    if args.stats:
+        total = stats.total()
+        print(f"[deltastar] total: {total['lines']} lines, {total['tokens']} tokens in {total['seconds']:.2f} s "
+              f"({total['tokens_per_sec']:,.0f} tokens/s)", file=sys.stderr)
+    return 0
+
+
+def compile_command(args) -> int:
+    machines = load_rule_file(args.rules, args.workers)
+    if len(machines) != 1 and not args.compose:
+        raise RuleError(f"{args.rules} defines {len(machines)} machines. Pass --compose to save them as one machine")
+
+    machine = compose(*machines) if len(machines) > 1 else machines[0]
+    if args.minimize:
+        machine.minimize()
+    machine.save(args.output)
+    print(f"[deltastar] saved {len(machine.table.states)} states to {args.output}", file=sys.stderr)
+    return 0
+
+
+def serve_command(args) -> int:
+    server = RewriteServer(load_machines(args.machines), args.max_batch, args.max_wait)
+    where = args.socket or f"{args.host}:{args.port}"
+    print(f"[deltastar] serving {', '.join(server.machines)} on {where}", file=sys.stderr)
+    try:
+        asyncio.run(server.serve_forever(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="deltastar", description="compile and apply deterministic rewrite rule transducers")
+    parser.add_argument("--version", action="version", version=f"deltastar {__version__}")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    rewrite = commands.add_parser("rewrite", help="rewrite a file or stdin, one string of space separated symbols per line")
+    rewrite.add_argument("machines", nargs="+", help="saved machines or JSON rule files, applied in order")
+    rewrite.add_argument("-i", "--input", help="file to rewrite. Defaults to stdin")
+    rewrite.add_argument("-o", "--output", help="file to write the rewrites to. Defaults to stdout")
+    rewrite.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes (for compiling rule files too)")
+    rewrite.add_argument("-c", "--chunk-size", type=int, default=CHUNK_SIZE, help="number of lines rewritten together")
+    rewrite.add_argument("--stats-interval", type=float, default=0, help="print throughput and latency every this many seconds (0 to disable)")
+    rewrite.add_argument("--stats", action="store_true", help="print the overall throughput at the end")
+    rewrite.add_argument("--encoding", default="utf8", help="encoding of the input and output files")
+    rewrite.add_argument("--no-mmap", action="store_true", help="read saved machines into memory instead of memory-mapping them")
+    rewrite.set_defaults(func=rewrite_command)
+
+    compile_ = commands.add_parser("compile", help="compile a JSON rule file and save the machine")
+    compile_.add_argument("rules", help="JSON rule file")
+    compile_.add_argument("-o", "--output", required=True, help="file to save the machine to")
+    compile_.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes compiling the machines")
+    compile_.add_argument("--compose", action="store_true", help="compose the machines of a rule file with several of them")
+    compile_.add_argument("--minimize", action="store_true", help="minimize the machine before saving it")
+    compile_.set_defaults(func=compile_command)
+
+    serve = commands.add_parser("serve", help="serve rewrites of saved machines over TCP or a Unix socket")
+    serve.add_argument("machines", nargs="+", help="saved machines, named after their file names")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--socket", help="path of a Unix socket to listen on instead of a TCP port")
+    serve.add_argument("--max-batch", type=int, default=MAX_BATCH, help="maximum number of strings rewritten together")
+    serve.add_argument("--max-wait", type=float, default=MAX_WAIT, help="maximum seconds a request waits for others to batch with")
+    serve.set_defaults(func=serve_command)
+
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except (OSError, ValueError, ContextError, RuleError, StorageError) as e:
+        print(f"deltastar: error: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
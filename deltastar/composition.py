@@ -0,0 +1,144 @@
+# -*- coding: utf8 -*-
+
+# this file contains the composition of two compiled machines into one machine that behaves like
+# B.rewrite(A.rewrite(s)) while reading s only once.
+#
+# every state of the composed machine is a state of A paired with the state B is in after reading everything A
+# has output so far. A's outputs are fed to B exactly like rewrite would: reserved symbols are stripped, the rest is
+# split into symbols (characters and [tags]), and B's word boundaries (and Ø symbols, for insertion machines) are added.
+#
+# NOTE: an input token A doesn't know passes through A's PH transition as a single PH symbol, and so through B's.
+# B.rewrite(A.rewrite(s)) reads such a token character by character instead, so composed machines only accept unknown
+# tokens that are single characters or [tags] (see check_symbols)
+
+from collections import defaultdict, deque
+from transitions import State, delta_row
+from utils.funcs import PH, RESERVED, intersperse, split_symbols
+
+# PH is kept so that it can travel through both machines as a placeholder for the input symbol
+STRIP_MARKERS = str.maketrans("", "", "".join(sym for sym in RESERVED if sym != PH))
+
+
+def check_symbols(table, syms):
+    """Makes sure a composed machine reads syms like the machines it was composed from would
+
+    Raises:
+        ValueError: if a symbol unknown to the machine is made of several characters or [tags]
+    """
+    ids = table.symbol_ids
+    for sym in syms:
+        if sym not in ids and len(split_symbols(sym)) > 1:
+            raise ValueError(f"composed machines can't read the unknown multi-character symbol {sym!r}. "
+                             f"Separate its characters with spaces ({' '.join(split_symbols(sym))!r})")
+
+
+def output_symbols(output:str):
+    """Splits a raw output tape into the symbols the next machine would read"""
+    return intersperse(output.translate(STRIP_MARKERS).strip()).split()
+
+
+def run(table, state:int, syms):
+    """Feeds symbols to a TransitionTable starting at state
+
+    Returns:
+        tuple[int, str]: the state reached and the raw output
+    """
+    out = []
+    for sym, sid in zip(syms, table.encode(syms)):
+        state, out_id, is_default = table.step(state, sid)
+        out.append(table.outputs[out_id].replace(PH, sym) if is_default else table.outputs[out_id])
+    return state, "".join(out)
+
+
+
+class _Feeder:
+    """Turns A's output symbols into B's input symbols, tracking whether B has read a symbol yet (insertion machines
+    read a Ø between symbols)"""
+
+    def __init__(self, table, insertion:bool):
+        self.table = table
+        self.insertion = insertion
+
+    def begin(self):
+        return ["$", "Ø"] if self.insertion else ["$"]
+
+    def end(self):
+        return ["Ø", "$"] if self.insertion else ["$"]
+
+    def feed(self, state, started, symbols):
+        """Returns the state B reaches, whether it has started, and its raw output"""
+        syms = []
+        for sym in symbols:
+            if self.insertion:
+                if started:
+                    syms.append("Ø")
+                syms.extend(sym) # insertion machines read their input character by character
+                started = True
+            else:
+                syms.append(sym)
+        state, out = run(self.table, state, syms)
+        return state, started, out
+
+
+
+def compose_tables(a, b, a_v0="", b_insertion=False):
+    """Composes two TransitionTables
+
+    Args:
+        a (TransitionTable): first machine
+        b (TransitionTable): second machine, which reads the output of the first
+        a_v0 (str): v0 of the first machine, which the second machine reads before anything else
+        b_insertion (bool): whether the second machine is an insertion machine (which changes how it reads its input)
+
+    Returns:
+        tuple[defaultdict, dict, str]: delta and finals of the composed machine, and the output the second machine
+        produces before the first input symbol (which the composed machine has to emit through its v0)
+    """
+    feeder = _Feeder(b, b_insertion)
+    sigma = list(dict.fromkeys(a.symbols[1:] + b.symbols[1:]))
+
+    b_state, start_out = run(b, 0, feeder.begin())
+    b_state, started, out = feeder.feed(b_state, False, output_symbols(a_v0))
+    start = (0, b_state, started and b_insertion)
+    start_out += out
+
+    labels = {start:State("λ")}
+    def label(pair):
+        if pair not in labels:
+            a_state, b_state, _ = pair
+            labels[pair] = State(f"{a.states[a_state]},{b.states[b_state]}" + ("'" if pair[2] else ""))
+        return labels[pair]
+
+    def step(pair, sym):
+        a_state, b_state, started = pair
+        a_state, out = run(a, a_state, [sym])
+        b_state, started, out = feeder.feed(b_state, started, output_symbols(out))
+        return (a_state, b_state, started and b_insertion), out
+
+    delta = defaultdict(delta_row)
+    finals = {}
+    queue = deque([start])
+    while queue:
+        pair = queue.popleft()
+        q = label(pair)
+
+        # PH stays a single PH symbol through both machines, so the composed PH output is still a template
+        default_end, default_out = step(pair, PH)
+        transitions = [(PH, default_out, default_end)]
+        for sym in sigma:
+            end, out = step(pair, sym)
+            if out != default_out.replace(PH, sym) or end != default_end:
+                transitions.append((sym, out, end))
+
+        for sym, out, end in transitions:
+            if end not in labels:
+                queue.append(end)
+            delta[q][sym] = [out, label(end)]
+
+        # the end of the input: A's final output, then B's closing boundary and final output
+        a_state, b_state, started = pair
+        b_state, started, out = feeder.feed(b_state, started, output_symbols(a.outputs[a.finals[a_state]]))
+        b_state, end_out = run(b, b_state, feeder.end())
+        finals[q] = out + end_out + b.outputs[b.finals[b_state]]
+
+    return delta, finals, start_out
@@ -1,7 +1,8 @@
+import os
 import sys
-sys.path.append("/home/eric/python/projects/deltastar/deltastar")
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
 
-from transducers import assimilation, deletion, insertion
+from transducers import assimilation, compose, deletion, insertion
 from itertools import product
 
 
@@ -48,4 +49,12 @@ mappings = [
     ("k", "g"),
 ]
 
-post_nasal_vce = assimilation(mappings, environments)
\ No newline at end of file
+post_nasal_vce = assimilation(mappings, environments)
+
+
+#
+### NASAL CASCADE
+#
+
+# applies nasal place assimilation and then post nasal voicing in a single pass
+nasal_cascade = compose(nasal_place_assim, post_nasal_vce)
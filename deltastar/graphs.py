@@ -0,0 +1,157 @@
+# -*- coding: utf8 -*-
+
+# this file contains the graph export behind DFST.to_graph. Graphs are built from the compiled transition table
+# and streamed to the file: every state and transition is written exactly once, without an intermediate graph object.
+#
+# supported formats:
+#   .dot    Graphviz source
+#   .json   {"q0": ..., "states": [...], "edges": [...]}, one state or edge per line
+#   .svg    rendered by the Graphviz `dot` program
+#   .png    rendered by the Graphviz `dot` program
+#
+# large machines can be cut down to the states around some chosen states, to transitions other than PH (?:?) ones,
+# or to the most taken transitions of an instrumented machine (see DFST.instrument)
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from collections import defaultdict
+from typing import List
+
+FORMATS = (".dot", ".json", ".svg", ".png")
+
+
+def select_edges(table, states:List[str]=None, radius=1, show_PH=False, top:int=None, counters=None) -> list:
+    """Picks the transitions of a table to draw
+
+    Args:
+        table (TransitionTable): compiled machine
+        states (List[str]): labels of states to center the graph on. Only transitions between states at most radius
+            transitions away from them (in either direction) are kept. Defaults to every state
+        radius (int): how far the graph reaches out from states
+        show_PH (bool): keep the ?:? transitions
+        top (int): only keep the top most taken transitions (transitions never taken are dropped)
+        counters (instrumentation.Counters): counters of the machine, required by top
+
+    Returns:
+        List[tuple]: (start state ID, symbol ID, next state ID, output ID) of the kept transitions
+    """
+    if top is not None and (counters is None or not counters.symbols):
+        raise ValueError("top needs the counters of an instrumented machine (see DFST.instrument)")
+    if radius < 0:
+        raise ValueError("radius can't be negative")
+
+    edges = list(table.edges(show_PH))
+
+    if states is not None:
+        ids = {label:state for state, label in enumerate(table.states)}
+        unknown = [label for label in states if label not in ids]
+        if unknown:
+            raise KeyError(f"unknown states: {', '.join(unknown)}")
+
+        neighbors = defaultdict(set)
+        for start, _, end, _ in edges:
+            neighbors[start].add(end)
+            neighbors[end].add(start)
+
+        kept = frontier = {ids[label] for label in states}
+        for _ in range(radius):
+            frontier = {n for state in frontier for n in neighbors[state]} - kept
+            kept = kept | frontier
+        edges = [edge for edge in edges if edge[0] in kept and edge[2] in kept]
+
+    if top is not None:
+        counted = [(counters.edge_count(start, sym), i) for i, (start, sym, _, _) in enumerate(edges)]
+        hottest = sorted((i for count, i in sorted(counted, key=lambda c: -c[0])[:top] if count))
+        edges = [edges[i] for i in hottest]
+
+    return edges
+
+
+def _quote(s:str) -> str:
+    return '"' + s.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def _states(table, edges):
+    """IDs of the states the edges touch, in ID order"""
+    return sorted({state for start, _, end, _ in edges for state in (start, end)})
+
+
+def _node_label(table, state) -> str:
+    final = table.outputs[table.finals[state]]
+    return f"{table.states[state]}, {final}" if final else table.states[state]
+
+
+def write_dot(f, table, edges, counters=None):
+    """Writes the edges as Graphviz source to an open text file. Edges of an instrumented machine are labeled with their counts"""
+    f.write('digraph finite_state_machine {\n\trankdir=LR;\n\tnode [shape=doublecircle];\n')
+    f.write('\tinitial [shape=point, color=white];\n')
+
+    states = _states(table, edges)
+    for state in states:
+        f.write(f"\t{state} [label={_quote(_node_label(table, state))}];\n")
+    if 0 in states:
+        f.write("\tinitial -> 0;\n")
+
+    for start, sym, end, out in edges:
+        label = f"{table.symbols[sym]}:{table.outputs[out]}"
+        if counters is not None and counters.symbols:
+            label += f" ({counters.edge_count(start, sym)})"
+        f.write(f"\t{start} -> {end} [label={_quote(label)}];\n")
+    f.write("}\n")
+
+
+def write_json(f, table, edges, counters=None):
+    """Writes the edges and the states they touch as JSON to an open text file. Edges of an instrumented machine get a count"""
+    f.write('{"q0": ' + json.dumps(table.states[0], ensure_ascii=False) + ',\n"states": [')
+    for i, state in enumerate(_states(table, edges)):
+        node = {"id": state, "label": table.states[state], "final": table.outputs[table.finals[state]]}
+        f.write(("\n" if i == 0 else ",\n") + json.dumps(node, ensure_ascii=False))
+
+    f.write('],\n"edges": [')
+    for i, (start, sym, end, out) in enumerate(edges):
+        edge = {"start": start, "end": end, "in": table.symbols[sym], "out": table.outputs[out]}
+        if counters is not None and counters.symbols:
+            edge["count"] = counters.edge_count(start, sym)
+        f.write(("\n" if i == 0 else ",\n") + json.dumps(edge, ensure_ascii=False))
+    f.write("]}\n")
+
+
+def render(dot_path:str, path:str, fmt:str):
+    """Renders a Graphviz source file to an image with the `dot` program
+
+    Raises:
+        RuntimeError: if Graphviz isn't installed
+    """
+    program = shutil.which("dot")
+    if program is None:
+        raise RuntimeError(f"rendering .{fmt} files requires Graphviz (https://graphviz.org/). Export to .dot or .json instead")
+    subprocess.run([program, f"-T{fmt}", dot_path, "-o", path], check=True)
+
+
+def export(table, path:str, states:List[str]=None, radius=1, show_PH=False, top:int=None, counters=None) -> int:
+    """Writes a graph of a compiled machine to path, in the format given by its extension (see FORMATS)
+
+    Returns:
+        int: number of transitions drawn
+    """
+    ext = os.path.splitext(str(path))[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f"unsupported graph format {ext!r}, expected one of {', '.join(FORMATS)}")
+
+    edges = select_edges(table, states, radius, show_PH, top, counters)
+    if ext == ".json":
+        with open(path, "w", encoding="utf8") as f:
+            write_json(f, table, edges, counters)
+    elif ext == ".dot":
+        with open(path, "w", encoding="utf8") as f:
+            write_dot(f, table, edges, counters)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            dot_path = os.path.join(tmp, "graph.dot")
+            with open(dot_path, "w", encoding="utf8") as f:
+                write_dot(f, table, edges, counters)
+            render(dot_path, str(path), ext[1:])
+    return len(edges)
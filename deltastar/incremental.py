@@ -0,0 +1,102 @@
+# -*- coding: utf8 -*-
+
+# this file contains the incremental rebuild behind DFST.add_rule and DFST.remove_rule.
+#
+# a state's row of delta only depends on its own context transitions, the states that extend its failure links
+# (see transitions.failure_links), the final outputs of those states, and (for right contexts) the transduction
+# environments its prefix transitions can complete. Context transitions are cheap to regenerate, so both rule sets
+# are expanded and compared, and only the rows of states whose inputs changed get their prefix transitions rebuilt
+
+from collections import defaultdict
+import transitions as tr
+
+
+def build(spec):
+    """Context transitions, per state index and prefix index of a list of (insym, outsym, context) rules"""
+    context_trans = tr.rule_transitions(spec)
+    return {
+        "spec": spec,
+        "context_trans": context_trans,
+        "by_start": tr.index_by_start(context_trans, keep_PH=True),
+        "index": tr.prefix_index(context_trans, tr.get_transduction_envs(spec)),
+    }
+
+
+def _edge_key(t, rule_map=None):
+    rule = t.rule if rule_map is None or t.rule is None else rule_map.get(t.rule, -1)
+    return (t.insym, t.outsym, t.end, t.ctype, t.is_transduction, t.seen_Lcon, rule)
+
+
+def _changed(old:dict, new:dict, key=lambda value: value, new_key=None):
+    """Keys whose values differ between two dictionaries (missing keys included)"""
+    new_key = key if new_key is None else new_key
+    return {k for k in old.keys() | new.keys() if k not in old or k not in new or key(old[k]) != new_key(new[k])}
+
+
+def affected_states(old, new, rule_map):
+    """Returns the states of the new machine whose rows of delta can differ from the old machine's.
+    rule_map maps the rule indices of the old machine to those of the new one (rules missing from it were removed)"""
+
+    old_index, new_index = old["index"], new["index"]
+    starts = _changed(old["by_start"], new["by_start"], key=lambda trans: [_edge_key(t, rule_map) for t in trans],
+                      new_key=lambda trans: [_edge_key(t) for t in trans])
+    finals = _changed(old_index["finals"], new_index["finals"])
+
+    # prefix transitions into new or removed states, or states with new final outputs, have to be rebuilt.
+    # New and removed states change the children of their parents, the others are added through their parents
+    parents = _changed(old_index["children"], new_index["children"])
+    sigma = set(old_index["sigma"]) | set(new_index["sigma"])
+    for q in finals:
+        parents.update(q.label[:i] for i in range(len(q.label)) if q.label[i:] in sigma)
+
+    # right context prefix transitions look for transduction environments that end right after them
+    envs = _changed(old_index["envs"], new_index["envs"], key=lambda mappings: [out for _, out in mappings])
+    env_prefixes = {env[:-len(sym)] for env in envs for sym in sigma if env.endswith(sym) and len(env) > len(sym)}
+
+    affected = set()
+    for q in new["by_start"]:
+        label = q.label
+        if q in starts or q in finals or any(label[i:] in parents for i in range(1, len(label)+1)):
+            affected.add(q)
+        elif any(label.endswith(prefix) and label != prefix for prefix in env_prefixes):
+            affected.add(q)
+    return affected
+
+
+def rebuild(delta, rule_edges, old_spec, new_spec, rule_map, old_build=None):
+    """Turns the delta of the machine built from old_spec into the delta of the machine built from new_spec
+
+    Args:
+        delta (defaultdict): transition function of the old machine (as returned by transitions.get_delta)
+        rule_edges (dict): (start state, insym) -> rule index of the old machine (as returned by transitions.get_rule_edges)
+        old_spec (List[tuple]): (insym, outsym, context) rules of the old machine
+        new_spec (List[tuple]): (insym, outsym, context) rules of the new machine
+        rule_map (dict): old rule index -> new rule index, for every rule that both machines have
+        old_build (dict): what build returned for old_spec, if it is still around
+
+    Returns:
+        tuple[defaultdict, dict, dict, set]: new delta, new rule edges, what build returns for new_spec
+        (pass it as old_build to the next rebuild), and the states whose rows were rebuilt
+    """
+    old = old_build if old_build is not None and old_build["spec"] is old_spec else build(old_spec)
+    new = build(new_spec)
+    affected = affected_states(old, new, rule_map)
+    
+    kept_rules = defaultdict(dict)
+    for (start, sym), rule in rule_edges.items():
+        if rule in rule_map:
+            kept_rules[start][start, sym] = rule_map[rule]
+
+    # rows are kept in the order a full build would create them
+    new_delta = defaultdict(tr.delta_row)
+    new_rule_edges = {}
+    for q in new["by_start"]:
+        if q in affected or q not in delta:
+            trans = tr.state_transitions(q, new["by_start"], new["index"])
+            new_delta[q] = tr.get_delta(trans)[q]
+            new_rule_edges.update(tr.get_rule_edges(trans, new_delta))
+        else:
+            new_delta[q] = delta[q]
+            new_rule_edges.update(kept_rules[q])
+
+    return new_delta, new_rule_edges, new, affected
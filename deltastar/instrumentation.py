@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+
+# this file contains the optional runtime counters of DFST.instrument: how often each state is visited,
+# how often each rewrite rule fires and each transition is taken, and how often the PH (any other symbol) transition is taken.
+#
+# only the transitions taken are counted while rewriting, one counter per (state, symbol) cell of the transition table.
+# Everything else is derived from those counts when the counters are read
+
+from array import array
+from collections import Counter
+from typing import List
+import numpy as np
+from tables import FLAT_MAX_CELLS
+
+
+class Counters:
+    """Cumulative runtime counters of a machine. Counting happens in the transduction loops, so a machine without
+    counters pays nothing for them
+
+    Args:
+        table (TransitionTable): compiled machine the counters belong to
+        rules (List[str]): rules of the machine (DFST.rules)
+    """
+
+    def __init__(self, table, rules:List[str]):
+        self.table = table
+        self.states = table.states
+        self.symbols = table.symbols
+        self.rules = rules
+        self.reset()
+
+    def __repr__(self):
+        return f"Counters(strings={self.strings}, steps={self.steps}, fallbacks={self.fallbacks})"
+
+    def reset(self):
+        """Sets every counter back to zero"""
+        self.strings = 0
+        # hits[state ID * len(symbols) + symbol ID] is the number of times a transition was taken. Symbol ID 0 is the PH transition.
+        # tables too large to be preallocated for are counted sparsely
+        cells = len(self.states) * len(self.symbols)
+        self.hits = array("q", bytes(8 * cells)) if cells <= FLAT_MAX_CELLS else Counter()
+
+    def add(self, strings:int, taken:np.ndarray):
+        """Records transductions
+
+        Args:
+            strings (int): number of strings transduced
+            taken (np.ndarray): cell (start state ID * len(symbols) + symbol ID) of the transition taken by every step
+        """
+        self.strings += strings
+        if isinstance(self.hits, array):
+            counts = np.frombuffer(self.hits, dtype=np.int64)
+            counts += np.bincount(taken, minlength=len(counts))
+        else:
+            keys, counts = np.unique(taken, return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                self.hits[key] += count
+
+    def _hit_cells(self):
+        """(cell, count) of every transition taken at least once, in cell order"""
+        if isinstance(self.hits, array):
+            counts = np.frombuffer(self.hits, dtype=np.int64)
+            cells = np.flatnonzero(counts)
+            return zip(cells.tolist(), counts[cells].tolist())
+        return sorted((key, count) for key, count in self.hits.items() if count)
+
+    def edge_count(self, state:int, sym:int) -> int:
+        """Number of times the transition on symbol ID sym (0 for PH) out of state ID state was taken"""
+        return self.hits[state * len(self.symbols) + sym]
+
+    @property
+    def steps(self) -> int:
+        return sum(count for _, count in self._hit_cells())
+
+    @property
+    def fallbacks(self) -> int:
+        """Number of steps that took the PH transition"""
+        return sum(count for cell, count in self._hit_cells() if cell % len(self.symbols) == 0)
+
+    @property
+    def fallback_rate(self) -> float:
+        """Fraction of steps that took the PH transition"""
+        steps = self.steps
+        return self.fallbacks / steps if steps else 0.0
+
+    @property
+    def state_visits(self) -> List[int]:
+        """Number of steps that reached each state, by state ID"""
+        visits = [0] * len(self.states)
+        for cell, count in self._hit_cells():
+            visits[self.table.step(*divmod(cell, len(self.symbols)))[0]] += count
+        return visits
+
+    @property
+    def rule_fires(self) -> List[int]:
+        """Number of times each rule applied, in DFST.rules order. None if the machine doesn't know which transitions
+        apply which rule (e.g. composed machines, whose transitions can apply rules of several machines at once)"""
+        if self.table.rule_edges is None:
+            return None
+        fires = [0] * len(self.rules)
+        for cell, count in self._hit_cells():
+            rule = self.table.rule_edges.get(divmod(cell, len(self.symbols)))
+            if rule is not None:
+                fires[rule] += count
+        return fires
+
+    def snapshot(self) -> dict:
+        """Copy of the counters, keyed by state label and rule
+
+        Returns:
+            dict: number of strings, steps and PH transitions taken, the fallback rate, visits of every visited state
+            (most visited first), firings of every rule (in DFST.rules order, unused rules included, or None if unknown, see rule_fires) and
+            {start state: {input symbol: count}} of every transition taken
+        """
+        visits = sorted(((count, state) for state, count in enumerate(self.state_visits) if count), reverse=True)
+        rule_fires, fires = self.rule_fires, None
+        if rule_fires is not None:
+            fires = {}
+            for rule, count in zip(self.rules, rule_fires):
+                fires[rule] = fires.get(rule, 0) + count
+
+        edges = {}
+        for cell, count in self._hit_cells():
+            state, sym = divmod(cell, len(self.symbols))
+            edges.setdefault(self.states[state], {})[self.symbols[sym]] = count
+
+        return {
+            "strings": self.strings,
+            "steps": self.steps,
+            "fallbacks": self.fallbacks,
+            "fallback_rate": self.fallback_rate,
+            "state_visits": {self.states[state]:count for count, state in visits},
+            "rule_fires": fires,
+            "edge_counts": edges,
+        }
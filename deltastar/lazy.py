@@ -0,0 +1,126 @@
+# -*- coding: utf8 -*-
+
+# this file contains LazyTable, the transition table of lazy machines (DFST.from_rules(..., lazy=True)).
+# only the context transitions are built up front. A state's prefix transitions are generated, and its row of delta
+# assembled, the first time a rewrite reaches it. Expanded rows are cached up to a configurable number of states
+
+from collections import OrderedDict
+from typing import List
+import transitions as tr
+from utils.funcs import PH
+
+# default maximum number of expanded states kept in memory
+MAX_STATES = 100_000
+
+
+class LazyTable:
+    """Expands states of a machine on demand. Rewrites are identical to those of the fully compiled machine
+
+    Args:
+        context_trans (List[Edge]): context transitions as returned by the *_transitions functions of transitions.py
+        transduction_envs (dict): transduction environments, as built by DFST.from_rules
+        spec (List[tuple]): (insym, outsym, context) rules the machine was built from, so it can be fully compiled later
+        max_states (int): maximum number of expanded states kept. When exceeded, the least recently used states are dropped
+            (and expanded again if they are reached later)
+    """
+
+    def __init__(self, context_trans, transduction_envs, spec, max_states=MAX_STATES):
+        if max_states < 1:
+            raise ValueError("max_states must be at least 1")
+
+        self.spec = spec
+        self.max_states = max_states
+        self.index = tr.prefix_index(context_trans, transduction_envs)
+        self.finals = {q.label:output for q, output in self.index["finals"].items()}
+
+        self.trans_by_start = tr.index_by_start(context_trans, keep_PH=True)
+
+        self.rows = OrderedDict() # least recently used first
+        self.expansions = 0
+        self.evictions = 0
+
+    def __repr__(self):
+        return f"LazyTable({self.info})"
+
+    @property
+    def states(self) -> List[str]:
+        return [q.label for q in self.trans_by_start]
+
+    @property
+    def info(self) -> dict:
+        """Number of states of the machine, currently expanded, expanded so far (re-expansions included), and dropped"""
+        return {
+            "states": len(self.trans_by_start),
+            "expanded": len(self.rows),
+            "max_states": self.max_states,
+            "expansions": self.expansions,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        """Drops every expanded state"""
+        self.rows.clear()
+
+    def expand(self, label:str):
+        """Builds (and caches) the row of delta of a state
+
+        Returns:
+            tuple[dict, tuple]: {input symbol: (next state label, output)} for explicit transitions, and the PH transition
+            as (next state label, output split around PH)
+        """
+        start = tr.State(label)
+        delta = tr.get_delta(tr.state_transitions(start, self.trans_by_start, self.index))[start]
+        if not delta.get(PH):
+            raise KeyError(f"state {label} has no {PH} transition")
+
+        out, end = delta[PH]
+        default = (end.label, out.split(PH))
+        edges = {sym:(end.label, out) for sym, (out, end) in delta.items() if sym != PH}
+
+        if len(self.rows) >= self.max_states:
+            self.rows.popitem(last=False)
+            self.evictions += 1
+        self.rows[label] = row = (edges, default)
+        self.expansions += 1
+        return row
+
+    def transduce(self, syms:List[str], trace=None, counters=None) -> str:
+        """Runs a tokenized string through the machine and returns the raw output tape, like TransitionTable.transduce
+
+        Args:
+            syms (List[str]): input symbols
+            trace (collections.deque): if given, (input symbol, state reached, output) entries are appended for every step,
+                followed by a (None, final state, final output) entry
+            counters: unsupported, lazy machines have to be fully compiled to be instrumented
+        """
+        if counters is not None:
+            raise ValueError("lazy machines can't be instrumented")
+
+        rows = self.rows
+        move_to_end = rows.move_to_end
+        out = []
+        append = out.append
+        state = "λ"
+        for sym in syms:
+            row = rows.get(state)
+            if row is None:
+                row = self.expand(state)
+            else:
+                move_to_end(state)
+            edge = row[0].get(sym)
+            if edge is None:
+                state, pieces = row[1]
+                append(sym.join(pieces))
+            else:
+                state, output = edge
+                append(output)
+            if trace is not None:
+                trace.append((sym, state, out[-1]))
+
+        append(self.finals.get(state, ""))
+        if trace is not None:
+            trace.append((None, state, out[-1]))
+        return "".join(out)
+
+    def transduce_many(self, batch:List[List[str]], counters=None) -> List[str]:
+        return [self.transduce(syms, counters=counters) for syms in batch]
@@ -0,0 +1,148 @@
+# -*- coding: utf8 -*-
+
+# this file contains the minimization pass for compiled machines:
+# unreachable states are pruned, outputs are pushed into onward form, and equivalent states are merged.
+#
+# every state of a DFST is final, and a state's PH transition covers every symbol it has no explicit transition for
+# (with PH in the output replaced by that symbol). States are compared over all symbols of sigma plus "any other symbol"
+
+from collections import defaultdict, deque
+from os.path import commonprefix
+from transitions import delta_row
+from utils.funcs import PH
+
+
+def _edges(delta):
+    # failed defaultdict lookups can leave empty entries behind in delta
+    return {q:{sym:t for sym, t in trans.items() if t} for q, trans in delta.items()}
+
+
+def reachable_states(delta, q0):
+    """Returns the states reachable from q0, in breadth first order"""
+    seen = {q0:None}
+    queue = deque([q0])
+    while queue:
+        q = queue.popleft()
+        for _, end in delta.get(q, {}).values():
+            if end not in seen:
+                seen[end] = None
+                queue.append(end)
+    return list(seen)
+
+
+def onward_prefixes(delta, finals, q0):
+    """Computes for each state the longest prefix shared by every output that can still be produced from it.
+    q0 gets the empty prefix since a DFST has no initial output"""
+
+    prefixes = {q:None for q in delta} # None = not constrained yet
+    changed = True
+    while changed:
+        changed = False
+        for q, trans in delta.items():
+            if q == q0:
+                prefixes[q] = ""
+                continue
+
+            candidates = [finals[q]]
+            for sym, (out, end) in trans.items():
+                if PH in out: # the output depends on the input symbol, so nothing after PH is shared
+                    candidates.append(out[:out.index(PH)])
+                elif prefixes[end] is not None:
+                    candidates.append(out + prefixes[end])
+
+            prefix = commonprefix(candidates)
+            if prefix != prefixes[q]:
+                prefixes[q] = prefix
+                changed = True
+    return prefixes
+
+
+def minimize(delta, finals, q0):
+    """Minimizes a machine
+
+    Args:
+        delta (dict): transition function as returned by transitions.get_delta
+        finals (dict): final output mappings
+        q0 (State): initial state
+
+    Returns:
+        tuple[defaultdict, dict, dict]: new delta, new finals, and a report of the states and edges removed
+    """
+    delta = _edges(delta)
+    edges_before = sum(len(trans) for trans in delta.values())
+    states_before = len(delta)
+
+    # prune
+    states = reachable_states(delta, q0)
+    delta = {q:delta[q] for q in states}
+    finals = {q:finals.get(q, "") for q in states}
+
+    # push outputs toward the initial state
+    prefixes = onward_prefixes(delta, finals, q0)
+    onward = {}
+    for q, trans in delta.items():
+        cut = len(prefixes[q])
+        onward[q] = {sym:(out + prefixes[end])[cut:] if PH not in out else out[cut:] + prefixes[end] for sym, (out, end) in trans.items()}
+        finals[q] = finals[q][cut:]
+
+    # totalize every state over sigma so that states can be compared symbol by symbol
+    sigma = sorted({sym for trans in delta.values() for sym in trans if sym != PH})
+    def behavior(q):
+        default = delta[q].get(PH)
+        for sym in sigma:
+            if sym in delta[q]:
+                yield sym, onward[q][sym], delta[q][sym][1]
+            elif default:
+                yield sym, onward[q][PH].replace(PH, sym), default[1]
+            else:
+                yield sym, None, None
+        yield PH, onward[q].get(PH), default[1] if default else None
+    rows = {q:list(behavior(q)) for q in states}
+
+    # Moore partition refinement, starting from states with identical outputs
+    block = {q:(finals[q], tuple(out for _, out, _ in rows[q])) for q in states}
+    while True:
+        signatures = {q:(block[q], tuple(block.get(end) for _, _, end in rows[q])) for q in states}
+        ids = {}
+        refined = {q:ids.setdefault(signatures[q], len(ids)) for q in states}
+        if len(ids) == len(set(block.values())):
+            block = refined
+            break
+        block = refined
+
+    # the first state of each block (in breadth first order, so q0 represents its own block) stands in for the rest
+    representative = {}
+    for q in states:
+        representative.setdefault(block[q], q)
+
+    new_delta = defaultdict(delta_row)
+    new_finals = {}
+    for q in states:
+        if representative[block[q]] != q:
+            continue
+        rep = lambda end: representative[block[end]]
+
+        default_out, default_end = rows[q][-1][1:]
+        if default_out is not None:
+            new_delta[q][PH] = [default_out, rep(default_end)]
+
+        # explicit transitions are only kept where the PH transition would do something different
+        for sym, out, end in rows[q][:-1]:
+            if out is None:
+                continue
+            if default_out is None or out != default_out.replace(PH, sym) or block[end] != block[default_end]:
+                new_delta[q][sym] = [out, rep(end)]
+        new_delta[q] # states without any transitions still need a row
+        new_finals[q] = finals[q]
+
+    report = {
+        "states_before": states_before,
+        "states_after": len(new_delta),
+        "unreachable_states": states_before - len(states),
+        "merged_states": len(states) - len(new_delta),
+        "edges_before": edges_before,
+        "edges_after": sum(len(trans) for trans in new_delta.values()),
+    }
+    report["states_removed"] = report["states_before"] - report["states_after"]
+    report["edges_removed"] = report["edges_before"] - report["edges_after"]
+    return new_delta, new_finals, report
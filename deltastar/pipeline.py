@@ -0,0 +1,107 @@
+# -*- coding: utf8 -*-
+
+# this file contains Pipeline, which runs a cascade of machines over lists of symbols.
+# Each stage's output tape is split straight into the next stage's input symbols instead of being turned
+# into a space-joined string and re-tokenized by the next machine's rewrite
+
+import time
+from typing import Iterable, Iterator, List
+from composition import check_symbols
+from utils.funcs import STRIP_RESERVED, split_symbols
+
+
+class Pipeline:
+    """Applies machines in order, such that Pipeline([A, B]).rewrite(s) == B.rewrite(A.rewrite(s))"""
+
+    def __init__(self, machines:list):
+        if not machines:
+            raise ValueError("a pipeline needs at least one machine")
+
+        # stages only need the compiled tables
+        self.stages = [machine.compiled() for machine in machines]
+        self.timings = [0.0] * len(self.stages)
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __repr__(self):
+        return f"Pipeline({len(self.stages)} stages)"
+
+    @property
+    def stats(self) -> List[dict]:
+        """Cumulative time spent in each stage, along with the stage's rules"""
+        total = sum(self.timings) or 1.0
+        return [{"stage": i, "rules": stage.rules, "seconds": seconds, "share": seconds / total}
+                for i, (stage, seconds) in enumerate(zip(self.stages, self.timings))]
+
+    def reset_stats(self):
+        self.timings = [0.0] * len(self.stages)
+
+    @staticmethod
+    def _wrap(stage, symbols:List[str]) -> List[str]:
+        """Adds a stage's word boundaries (and the Ø symbols insertion machines read between symbols)"""
+        if stage.rule_type == "insertion":
+            return ["$", "Ø", *"Ø".join(symbols), "Ø", "$"]
+        if stage.composed:
+            check_symbols(stage.table, symbols)
+        return ["$", *symbols, "$"]
+
+    @staticmethod
+    def _unwrap(stage, output:str) -> List[str]:
+        """Splits a stage's raw output tape into the symbols the next stage reads"""
+        return split_symbols(stage.v0 + output.translate(STRIP_RESERVED))
+
+    def rewrite(self, s:str) -> str:
+        """Rewrite a string through every stage
+
+        Args:
+            s (str): string to undergo transduction
+
+        Returns:
+            str: new string
+        """
+        symbols = s.split()
+        for i, stage in enumerate(self.stages):
+            start = time.perf_counter()
+            symbols = self._unwrap(stage, stage.table.transduce(self._wrap(stage, symbols)))
+            self.timings[i] += time.perf_counter() - start
+        return " ".join(symbols)
+
+    def rewrite_many(self, strings:List[str]) -> List[str]:
+        """Rewrite many strings through every stage. Each stage steps the whole batch at once (see DFST.rewrite_many)
+
+        Args:
+            strings (List[str]): strings to undergo transduction
+
+        Returns:
+            List[str]: new strings, in the same order as the input
+        """
+        batch = [s.split() for s in strings]
+        for i, stage in enumerate(self.stages):
+            start = time.perf_counter()
+            outputs = stage.table.transduce_many([self._wrap(stage, symbols) for symbols in batch])
+            batch = [self._unwrap(stage, output) for output in outputs]
+            self.timings[i] += time.perf_counter() - start
+        return [" ".join(symbols) for symbols in batch]
+
+    def rewrite_stream(self, lines:Iterable[str], batch_size=1024) -> Iterator[str]:
+        """Lazily rewrite an iterable of strings through every stage, batch_size strings at a time
+
+        Args:
+            lines (Iterable[str]): strings to undergo transduction. Trailing newlines are removed
+            batch_size (int): number of strings rewritten together with rewrite_many
+
+        Yields:
+            str: new strings, in the same order as the input
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+
+        batch = []
+        for line in lines:
+            batch.append(line.rstrip("\n"))
+            if len(batch) == batch_size:
+                yield from self.rewrite_many(batch)
+                batch = []
+        if batch:
+            yield from self.rewrite_many(batch)
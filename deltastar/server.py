@@ -0,0 +1,259 @@
+# -*- coding: utf8 -*-
+
+# this file contains a local rewrite server, which keeps compiled machines loaded in one warm process.
+#
+# the protocol is one JSON object per line, over TCP or a Unix socket:
+#   request:  {"machine": "voicing", "text": "a t a", "id": 7}      (machine can be left out if the server has one machine)
+#   response: {"text": "a ɾ a", "id": 7}  or  {"error": "...", "id": 7}
+# responses are written in the order of the requests of each connection, so clients can pipeline requests.
+#
+# concurrent requests for the same machine are grouped into micro-batches and rewritten together with DFST.rewrite_many.
+# A batch is run once it holds max_batch requests, or max_wait seconds after its first request arrived
+
+import asyncio
+import json
+import os
+import socket
+import time
+from typing import Dict, List
+from transducers import DFST
+
+# default micro-batch limits
+MAX_BATCH = 256
+MAX_WAIT = 0.002 # seconds
+
+
+def load_machines(paths:List[str], mmap=True) -> Dict[str, "DFST"]:
+    """Loads machines saved with DFST.save, named after their file names (without extension)"""
+    return {os.path.splitext(os.path.basename(path))[0]:DFST.load(path, mmap=mmap) for path in paths}
+
+
+
+class RewriteServer:
+    """Serves rewrites of a set of machines
+
+    Args:
+        machines (Dict[str, DFST]): machines by the name requests refer to them with
+        max_batch (int): maximum number of strings rewritten together
+        max_wait (float): maximum number of seconds a request waits for more requests to batch with
+    """
+
+    def __init__(self, machines:Dict[str, "DFST"], max_batch=MAX_BATCH, max_wait=MAX_WAIT):
+        if not machines:
+            raise ValueError("a server needs at least one machine")
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        if max_wait < 0:
+            raise ValueError("max_wait can't be negative")
+
+        # rewriting only needs the compiled tables
+        self.machines = {name:machine.compiled() for name, machine in machines.items()}
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = 0
+        self.batches = 0
+        self.busy_seconds = 0.0
+        self._queues = {}
+        self._batchers = []
+        self._server = None
+
+    def __repr__(self):
+        return f"RewriteServer({', '.join(self.machines)})"
+
+    @property
+    def stats(self) -> dict:
+        """Number of requests and batches served, average batch size, and time spent rewriting"""
+        return {
+            "requests": self.requests,
+            "batches": self.batches,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "busy_seconds": self.busy_seconds,
+        }
+
+    async def start(self, host="127.0.0.1", port=0, path=None):
+        """Starts listening on a TCP port, or on a Unix socket if path is given
+
+        Returns:
+            asyncio.AbstractServer: the listening server. Its sockets tell which port was bound when port is 0
+        """
+        for name in self.machines:
+            self._queues[name] = asyncio.Queue()
+            self._batchers.append(asyncio.create_task(self._batcher(name)))
+
+        if path is not None:
+            self._server = await asyncio.start_unix_server(self._handle, path=path)
+        else:
+            self._server = await asyncio.start_server(self._handle, host=host, port=port)
+        return self._server
+
+    async def close(self):
+        """Stops listening and stops the batchers"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for task in self._batchers:
+            task.cancel()
+        await asyncio.gather(*self._batchers, return_exceptions=True)
+        self._batchers.clear()
+        self._queues.clear()
+
+    async def serve_forever(self, host="127.0.0.1", port=0, path=None):
+        server = await self.start(host, port, path)
+        try:
+            await server.serve_forever()
+        finally:
+            await self.close()
+
+    async def rewrite(self, text:str, machine:str=None) -> str:
+        """Queues a string for the next batch of a machine and waits for its rewrite"""
+        if not isinstance(text, str):
+            raise TypeError(f"text must be a string, not {type(text).__name__}")
+        if machine is None:
+            if len(self.machines) != 1:
+                raise KeyError("the server has several machines, so requests have to name one")
+            machine = next(iter(self.machines))
+        if machine not in self._queues:
+            raise KeyError(f"unknown machine {machine!r}")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queues[machine].put((text, future))
+        return await future
+
+    async def _batcher(self, name):
+        queue = self._queues[name]
+        machine = self.machines[name]
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    # take whatever is already waiting, without waiting any longer
+                    while len(batch) < self.max_batch and not queue.empty():
+                        batch.append(queue.get_nowait())
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            start = time.perf_counter()
+            try:
+                outputs = machine.rewrite_many([text for text, _ in batch])
+            except Exception:
+                # one bad string shouldn't fail the requests it was batched with, so the batch is retried string by string
+                outputs = [self._rewrite_one(machine, text) for text, _ in batch]
+            self.busy_seconds += time.perf_counter() - start
+            self.requests += len(batch)
+            self.batches += 1
+
+            for (_, future), output in zip(batch, outputs):
+                if future.done(): # the client went away
+                    continue
+                if isinstance(output, Exception):
+                    future.set_exception(output)
+                else:
+                    future.set_result(output)
+
+    @staticmethod
+    def _rewrite_one(machine, text:str):
+        """The rewrite of a single string, or the exception rewriting it raised"""
+        try:
+            return machine.rewrite(text)
+        except Exception as e:
+            return e
+
+    async def _respond(self, line:bytes) -> dict:
+        response = {}
+        try:
+            request = json.loads(line)
+            if "id" in request:
+                response["id"] = request["id"]
+            response["text"] = await self.rewrite(request["text"], request.get("machine"))
+        except Exception as e:
+            response["error"] = f"{type(e).__name__}: {e}"
+        return response
+
+    async def _handle(self, reader, writer):
+        # each request is answered by its own task, so that requests of one connection can share a batch.
+        # Responses are written in request order
+        pending = asyncio.Queue()
+
+        async def write_responses():
+            while True:
+                task = await pending.get()
+                if task is None:
+                    break
+                writer.write(json.dumps(await task, ensure_ascii=False).encode("utf8") + b"\n")
+                await writer.drain()
+
+        writer_task = asyncio.create_task(write_responses())
+        try:
+            async for line in reader:
+                if line.strip():
+                    await pending.put(asyncio.create_task(self._respond(line)))
+        except ConnectionError:
+            pass
+        finally:
+            await pending.put(None)
+            try:
+                await writer_task
+            except ConnectionError:
+                pass
+            writer.close()
+
+
+
+class Client:
+    """Blocking client of a RewriteServer, for services that don't run an event loop
+
+    Args:
+        host (str): host of a TCP server
+        port (int): port of a TCP server
+        path (str): path of a Unix socket server (instead of host and port)
+        timeout (float): socket timeout in seconds
+    """
+
+    def __init__(self, host="127.0.0.1", port=None, path=None, timeout=None):
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.file = self.sock.makefile("rwb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def rewrite_many(self, strings:List[str], machine:str=None) -> List[str]:
+        """Sends every string at once (so the server can batch them) and returns their rewrites in order
+
+        Raises:
+            RuntimeError: if the server couldn't rewrite a string
+        """
+        for i, s in enumerate(strings):
+            request = {"id": i, "text": s}
+            if machine is not None:
+                request["machine"] = machine
+            self.file.write(json.dumps(request, ensure_ascii=False).encode("utf8") + b"\n")
+        self.file.flush()
+
+        outputs = []
+        for _ in strings:
+            response = json.loads(self.file.readline())
+            if "error" in response:
+                raise RuntimeError(response["error"])
+            outputs.append(response["text"])
+        return outputs
+
+    def rewrite(self, s:str, machine:str=None) -> str:
+        return self.rewrite_many([s], machine)[0]
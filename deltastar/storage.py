@@ -0,0 +1,126 @@
+# -*- coding: utf8 -*-
+
+# this file contains the versioned binary format that compiled DFSTs are saved in.
+#
+# layout (all integers little-endian):
+#   magic (6 bytes) | format version (uint16) | header length (uint32) | header (utf8 JSON) | padding | arrays
+#
+# the JSON header holds the metadata (rule type, v0, rules), the state, symbol and output tables, the rule applied by
+# each transition (if known), and the byte offset and length of every int32 array of the TransitionTable.
+# Arrays are 8-byte aligned so they can be memory-mapped.
+#
+# version 2 also stores the flat form of the table (TransitionTable.flat) when it has one, so that rewriting runs on the
+# memory-mapped file instead of a private copy in every process. Version 1 files are still read
+
+import json
+import mmap as _mmap
+import struct
+import sys
+from array import array
+from tables import TransitionTable, ARRAY_FIELDS, FLAT_FIELDS
+from utils.funcs import StorageError
+
+MAGIC = b"DSTAR\x00"
+FORMAT_VERSION = 2
+PREAMBLE = struct.Struct("<6sHI")
+ALIGN = 8
+
+def _aligned(offset):
+    return offset + (-offset % ALIGN)
+
+
+def save_table(table:TransitionTable, path, metadata:dict):
+    """Writes a TransitionTable and its machine's metadata to path
+
+    Args:
+        table (TransitionTable): table to save
+        path (str): file to write
+        metadata (dict): JSON serializable data stored alongside the table (rule type, v0, rules)
+    """
+    flat = table.flat()
+    fields = ARRAY_FIELDS + (FLAT_FIELDS if flat is not None else ())
+    flat_arrays = dict(zip(FLAT_FIELDS, flat[2:4])) if flat is not None else {}
+
+    arrays = []
+    for name in fields:
+        arr = array("i", flat_arrays[name] if name in flat_arrays else getattr(table, name))
+        if sys.byteorder != "little":
+            arr.byteswap()
+        arrays.append((name, arr.tobytes()))
+
+    # offsets are relative to the start of the array section, which begins at the first aligned byte after the header
+    layout, offset = {}, 0
+    for name, data in arrays:
+        layout[name] = [offset, len(data) // 4]
+        offset = _aligned(offset + len(data))
+
+    header = json.dumps({
+        "metadata": metadata,
+        "states": table.states,
+        "symbols": table.symbols,
+        "outputs": table.outputs,
+        "arrays": layout,
+        "rule_edges": None if table.rule_edges is None else [[state, sym, rule] for (state, sym), rule in table.rule_edges.items()],
+    }, ensure_ascii=False).encode("utf8")
+
+    with open(path, "wb") as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        f.write(header)
+        f.write(b"\0" * (_aligned(f.tell()) - f.tell()))
+        start = f.tell()
+        for name, data in arrays:
+            f.write(b"\0" * (start + layout[name][0] - f.tell()))
+            f.write(data)
+
+
+def load_table(path, mmap=True):
+    """Reads a file written by save_table
+
+    Args:
+        path (str): file to read
+        mmap (bool): memory-map the arrays instead of reading them into memory. The mapping is shared
+            between every process that loads the same file
+
+    Returns:
+        tuple[TransitionTable, dict]: the table and the saved metadata
+    """
+    with open(path, "rb") as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) != PREAMBLE.size:
+            raise StorageError(f"{path} is not a deltastar machine")
+        magic, version, header_len = PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            raise StorageError(f"{path} is not a deltastar machine")
+        if not 1 <= version <= FORMAT_VERSION:
+            raise StorageError(f"{path} uses format version {version}, expected at most {FORMAT_VERSION}")
+
+        header = json.loads(f.read(header_len).decode("utf8"))
+        start = _aligned(PREAMBLE.size + header_len)
+
+        # big-endian machines can't use the little-endian data in place
+        if mmap and sys.byteorder == "little":
+            buffer = memoryview(_mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_READ))
+            arrays = {name:buffer[start+offset:start+offset+length*4].cast("i") for name, (offset, length) in header["arrays"].items()}
+        else:
+            f.seek(0)
+            data = f.read()
+            arrays = {}
+            for name, (offset, length) in header["arrays"].items():
+                arrays[name] = array("i", data[start+offset:start+offset+length*4])
+                if sys.byteorder != "little":
+                    arrays[name].byteswap()
+
+    missing = set(ARRAY_FIELDS) - set(arrays)
+    if any(name in arrays for name in FLAT_FIELDS):
+        missing |= set(FLAT_FIELDS) - set(arrays)
+    if missing:
+        raise StorageError(f"{path} is missing arrays: {', '.join(sorted(missing))}")
+
+    # files written before rule attribution existed have no rule_edges
+    rule_edges = header.get("rule_edges")
+    if rule_edges is not None:
+        rule_edges = {(state, sym):rule for state, sym, rule in rule_edges}
+
+    table = TransitionTable(header["states"], header["symbols"], header["outputs"],
+                            **{name:arrays[name] for name in ARRAY_FIELDS + FLAT_FIELDS if name in arrays}, rule_edges=rule_edges)
+    return table, header["metadata"]
@@ -0,0 +1,69 @@
+# -*- coding: utf8 -*-
+
+# this file contains the symbol table that maps symbols (characters, multi character symbols and [tags]) to small integer IDs
+
+from typing import Iterable, List
+from utils.funcs import PH, SYMBOL
+
+
+class SymbolTable:
+    """Interns symbols as consecutive integer IDs. ID 0 is always PH, which every unknown symbol maps to"""
+
+    def __init__(self, symbols:Iterable[str]=()):
+        self.symbols = [PH]
+        self.ids = {PH:0}
+        for sym in symbols:
+            self.add(sym)
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def __contains__(self, sym):
+        return sym in self.ids
+
+    def __iter__(self):
+        return iter(self.symbols)
+
+    def __repr__(self):
+        return f"SymbolTable({len(self.symbols)} symbols)"
+
+    def __getstate__(self):
+        return self.symbols
+
+    def __setstate__(self, symbols):
+        self.symbols = list(symbols)
+        self.ids = {sym:i for i, sym in enumerate(self.symbols)}
+
+    def add(self, sym:str) -> int:
+        """Interns a symbol (if it isn't already) and returns its ID"""
+        if sym not in self.ids:
+            self.ids[sym] = len(self.symbols)
+            self.symbols.append(sym)
+        return self.ids[sym]
+
+    def id(self, sym:str) -> int:
+        return self.ids.get(sym, 0)
+
+    def encode(self, syms:Iterable[str]) -> List[int]:
+        """Maps symbols to IDs. Unknown symbols are mapped to the PH ID (0)"""
+        get = self.ids.get
+        return [get(sym, 0) for sym in syms]
+
+    def decode(self, ids:Iterable[int]) -> List[str]:
+        symbols = self.symbols
+        return [symbols[i] for i in ids]
+
+    def tokenize(self, text:str, spaced=True) -> List[int]:
+        """Turns raw text into symbol IDs in one pass
+
+        Args:
+            text (str): text to tokenize
+            spaced (bool): whether symbols are separated by whitespace (like the input of rewrite). Otherwise the text is
+                split into [tags] and single characters (like the output of rewrite before interspersing)
+
+        Returns:
+            List[int]: symbol IDs
+        """
+        get = self.ids.get
+        tokens = text.split() if spaced else SYMBOL.findall(text)
+        return [get(tok, 0) for tok in tokens]
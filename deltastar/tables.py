@@ -0,0 +1,434 @@
+# -*- coding: utf8 -*-
+
+# this file contains the compiled, integer-indexed form of delta that the rewrite engine runs on.
+# states and input symbols are mapped to dense IDs and every transition is stored in flat arrays
+
+from array import array
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from itertools import chain, repeat
+from typing import List
+import numpy as np
+from symbols import SymbolTable
+from utils.funcs import PH
+
+# a row is stored direct-indexed once at least this fraction of the symbol columns are filled
+DENSE_THRESHOLD = 0.5
+NO_EDGE = -1
+
+# number of strings stepped together in one vectorized pass of transduce_many
+BATCH_SIZE = 4096
+
+# fewest strings stepped together by one numpy step of transduce_many. Below that, stepping strings one by one is faster
+MIN_LANES = 64
+
+# largest number of cells (states x symbols) expanded into the flat form of a table. Larger tables are stepped through
+# their sparse and dense rows instead
+FLAT_MAX_CELLS = 1 << 22
+
+# names of the int32 array fields of TransitionTable
+ARRAY_FIELDS = ("finals", "default_next", "default_out", "row_ptr", "sparse_syms", "sparse_next", "sparse_out",
+                "dense_row", "dense_next", "dense_out")
+
+# names of the optional int32 array fields holding the flat form of the table (see TransitionTable.flat)
+FLAT_FIELDS = ("next_cell", "code")
+
+@dataclass
+class TransitionTable:
+
+    states:List[str]    # state labels, index = state ID (0 is always q0)
+    symbols:List[str]   # input symbols, index = symbol ID (0 is always PH)
+    outputs:List[str]   # interned output strings, index = output ID
+    finals:array        # final output ID per state
+
+    # NOTE: every array field may also be a memoryview of int32s (e.g. when memory-mapped by storage.load_table)
+
+    # PH transition for each state. Its output still contains PH, which gets replaced by the input symbol
+    default_next:array
+    default_out:array
+
+    # sparse rows: edges of state s live in [row_ptr[s], row_ptr[s+1]), sorted by symbol ID
+    row_ptr:array
+    sparse_syms:array
+    sparse_next:array
+    sparse_out:array
+
+    # dense rows: dense_row[s] is the row index of state s (or NO_EDGE if the row is sparse).
+    # row r occupies [r * len(symbols), (r+1) * len(symbols)) in dense_next and dense_out
+    dense_row:array
+    dense_next:array
+    dense_out:array
+
+    # (state ID, symbol ID) -> index of the rewrite rule (in DFST.rules) the transition applies. Symbol ID 0 is the PH transition
+    rule_edges:dict = None
+
+    # flat form of the table, if it was saved with it (see TransitionTable.flat). Otherwise it is built on first use
+    next_cell:array = None
+    code:array = None
+
+    symbol_table:SymbolTable = field(init=False, repr=False)
+    _flat:tuple = field(init=False, repr=False, default=None)
+    _decode:tuple = field(init=False, repr=False, default=None)
+
+    def __post_init__(self):
+        self.symbol_table = SymbolTable(self.symbols[1:])
+
+    def __getstate__(self):
+        # the flat form of the table is a cache and can be rebuilt cheaply, so it is not shipped to other processes.
+        # memory-mapped arrays can't be pickled and are copied out
+        state = self.__dict__.copy()
+        state["_flat"] = None
+        state["_decode"] = None
+        for name in ARRAY_FIELDS + FLAT_FIELDS:
+            if isinstance(state[name], memoryview):
+                state[name] = array("i", state[name])
+        return state
+
+    def __repr__(self):
+        return f"TransitionTable(states={len(self.states)}, symbols={len(self.symbols)}, outputs={len(self.outputs)})"
+
+    @property
+    def num_edges(self):
+        """Number of explicit (non PH) transitions"""
+        dense = sum(1 for n in self.dense_next if n != NO_EDGE)
+        return len(self.sparse_syms) + dense
+
+    @property
+    def symbol_ids(self):
+        return self.symbol_table.ids
+
+    def encode(self, syms) -> List[int]:
+        """Maps a sequence of input symbols to symbol IDs. Unknown symbols are mapped to the PH ID (0)"""
+        return self.symbol_table.encode(syms)
+
+    def step(self, state:int, sym:int):
+        """Looks up a single transition
+
+        Args:
+            state (int): state ID
+            sym (int): symbol ID
+
+        Returns:
+            tuple[int, int, bool]: next state ID, output ID, and whether the PH transition was taken
+        """
+        row = self.dense_row[state]
+        if row != NO_EDGE:
+            idx = row * len(self.symbols) + sym
+            nxt = self.dense_next[idx]
+            if nxt != NO_EDGE:
+                return nxt, self.dense_out[idx], False
+        else:
+            lo, hi = self.row_ptr[state], self.row_ptr[state+1]
+            idx = bisect_left(self.sparse_syms, sym, lo, hi)
+            if idx < hi and self.sparse_syms[idx] == sym:
+                return self.sparse_next[idx], self.sparse_out[idx], False
+
+        if self.default_next[state] == NO_EDGE:
+            raise KeyError(f"state {self.states[state]} has no {PH} transition")
+        return self.default_next[state], self.default_out[state], True
+
+    def edges(self, show_PH=True):
+        """Yields every transition of the table once, state by state
+
+        Args:
+            show_PH (bool): include the PH transition of every state (with symbol ID 0)
+
+        Yields:
+            tuple[int, int, int, int]: start state ID, symbol ID, next state ID, output ID
+        """
+        num_syms = len(self.symbols)
+        for state in range(len(self.states)):
+            if show_PH and self.default_next[state] != NO_EDGE:
+                yield state, 0, self.default_next[state], self.default_out[state]
+            row = self.dense_row[state]
+            if row != NO_EDGE:
+                start = row * num_syms
+                for sym in range(num_syms):
+                    if self.dense_next[start+sym] != NO_EDGE:
+                        yield state, sym, self.dense_next[start+sym], self.dense_out[start+sym]
+            else:
+                for idx in range(self.row_ptr[state], self.row_ptr[state+1]):
+                    yield state, self.sparse_syms[idx], self.sparse_next[idx], self.sparse_out[idx]
+
+    def flat(self):
+        """Expands the table into its total, direct-indexed form: two int32 arrays of len(states) * len(symbols) cells,
+        where cell state * len(symbols) + symbol ID holds the transition taken on that symbol. Symbols without an explicit
+        transition hold the PH transition, like column 0 (PH itself). A state is represented by the index of its first cell,
+        so a step is one addition and two lookups, and never searches a row or raises.
+        
+        next_cell holds the first cell of the next state. code holds the output ID of explicit transitions,
+        or ~output ID of PH transitions, whose outputs are split around PH into prefixes and suffixes. Tables loaded with
+        their flat form (see storage.save_table) use the saved, possibly memory-mapped, arrays instead of building them
+
+        Returns:
+            tuple | None: next_cell and code (numpy arrays), memoryviews of both (much faster to index one cell at a time),
+            and the prefix and suffix of every output (None for outputs without exactly one PH). None if the table has more
+            than FLAT_MAX_CELLS cells, some state has no PH transition, or a PH output doesn't contain exactly one PH
+            (transduce then steps the arrays)
+        """
+        if self._flat is None:
+            num_states, num_syms = len(self.states), len(self.symbols)
+            templates = [output.split(PH) if output.count(PH) == 1 else (None, None) for output in self.outputs]
+            prefixes, suffixes = (list(column) for column in zip(*templates)) if templates else ([], [])
+
+            if self.next_cell is not None:
+                # saved with the table: used in place, so memory-mapped arrays stay shared between processes
+                next_cell, code = memoryview(self.next_cell), memoryview(self.code)
+                self._flat = (np.frombuffer(next_cell, dtype=np.int32), np.frombuffer(code, dtype=np.int32),
+                              next_cell, code, prefixes, suffixes)
+                return self._flat
+
+            view = lambda arr: np.array(arr, dtype=np.int32)
+            default_next, default_out = view(self.default_next), view(self.default_out)
+            if (num_states * num_syms > FLAT_MAX_CELLS or (default_next == NO_EDGE).any()
+                    or any(templates[out][0] is None for out in set(default_out.tolist()))):
+                self._flat = False
+                return None
+
+            next_cell = np.repeat(default_next * num_syms, num_syms)
+            code = np.repeat(~default_out, num_syms)
+
+            dense_row = view(self.dense_row)
+            dense_states = np.flatnonzero(dense_row != NO_EDGE)
+            if len(dense_states):
+                rows = dense_row[dense_states]
+                dense_next = view(self.dense_next).reshape(-1, num_syms)[rows]
+                dense_out = view(self.dense_out).reshape(-1, num_syms)[rows]
+                owners, syms = np.nonzero(dense_next != NO_EDGE)
+                cells = dense_states[owners] * num_syms + syms
+                next_cell[cells] = dense_next[owners, syms] * num_syms
+                code[cells] = dense_out[owners, syms]
+
+            sparse_owners = np.repeat(np.arange(num_states), np.diff(view(self.row_ptr)))
+            cells = sparse_owners * num_syms + view(self.sparse_syms)
+            next_cell[cells] = view(self.sparse_next) * num_syms
+            code[cells] = view(self.sparse_out)
+
+            self._flat = next_cell, code, memoryview(next_cell), memoryview(code), prefixes, suffixes
+        return self._flat or None
+
+    def transduce_many(self, batch:List[List[str]], counters=None) -> List[str]:
+        """Vectorized transduce over many tokenized strings. The strings of a chunk are encoded into one array of symbol IDs,
+        advanced together one symbol position at a time over the flat form of the table (see TransitionTable.flat),
+        and their outputs are gathered from object arrays of the output pieces. A numpy step only pays off over enough
+        strings, so strings longer than all but MIN_LANES - 1 others of their chunk are transduced one by one
+
+        Args:
+            batch (List[List[str]]): tokenized input strings
+            counters (instrumentation.Counters): if given, the transitions taken are counted
+
+        Returns:
+            List[str]: raw output tapes, in input order
+        """
+        if self.flat() is None:
+            return [self.transduce(syms, counters=counters) for syms in batch]
+
+        results = []
+        for start in range(0, len(batch), BATCH_SIZE):
+            chunk = batch[start:start+BATCH_SIZE]
+            lengths = [len(syms) for syms in chunk]
+            cutoff = sorted(lengths, reverse=True)[MIN_LANES-1] if len(chunk) >= MIN_LANES else -1
+
+            wide = [syms for syms, length in zip(chunk, lengths) if length <= cutoff]
+            outputs = iter(self._step_many(wide, counters))
+            results.extend(next(outputs) if length <= cutoff else self.transduce(syms, counters=counters)
+                           for syms, length in zip(chunk, lengths))
+        return results
+
+    def _step_many(self, batch:List[List[str]], counters=None) -> List[str]:
+        """Steps every string of a batch together over the flat form of the table (see transduce_many)"""
+        next_cell, code, _, _, _, _ = self.flat()
+        outputs, prefixes, suffixes, plain = self._pieces()
+        ids = self.symbol_ids
+
+        lengths = np.fromiter(map(len, batch), dtype=np.int64, count=len(batch))
+        syms = list(chain.from_iterable(batch))
+        sids = np.fromiter(map(ids.get, syms, repeat(0)), dtype=np.int32, count=len(syms))
+        offsets = np.zeros(len(batch), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+
+        # strings are stepped longest first, so the strings still running at position t are the first active[t] ones
+        order = np.argsort(-lengths, kind="stable")
+        sorted_lengths, sorted_offsets = lengths[order], offsets[order]
+        width = int(sorted_lengths[0]) if len(batch) else 0
+        active = np.searchsorted(-sorted_lengths, -np.arange(width), side="left")
+
+        cell = np.zeros(len(batch), dtype=np.int32)
+        codes = np.empty(len(syms), dtype=np.int32)
+        taken = []
+        for t in range(width):
+            k = active[t]
+            pos = sorted_offsets[:k] + t
+            idx = cell[:k] + sids[pos]
+            codes[pos] = code[idx]
+            if counters is not None:
+                taken.append(np.where(codes[pos] >= 0, idx, cell[:k])) # PH transitions are counted on column 0
+            cell[:k] = next_cell[idx]
+
+        if counters is not None:
+            counters.add(len(batch), np.concatenate(taken) if taken else np.zeros(0, dtype=np.int32))
+
+        # decode every symbol at once, then join each string's pieces. Most PH outputs are the input symbol itself
+        pieces = np.array(syms, dtype=object)
+        explicit = codes >= 0
+        pieces[explicit] = outputs[codes[explicit]]
+        wrapped = ~explicit
+        wrapped[wrapped] = ~plain[~codes[wrapped]]
+        templates = ~codes[wrapped]
+        pieces[wrapped] = prefixes[templates] + pieces[wrapped] + suffixes[templates]
+        finals = np.empty(len(batch), dtype=object)
+        finals[order] = outputs[np.asarray(self.finals)[cell // len(self.symbols)]]
+
+        pieces = pieces.tolist()
+        return ["".join(pieces[o:o+l]) + final for o, l, final in zip(offsets.tolist(), lengths.tolist(), finals.tolist())]
+
+    def _pieces(self):
+        """outputs, prefixes and suffixes of the flat form (see TransitionTable.flat) as numpy object arrays, and whether
+        each output is PH alone, for transduce_many"""
+        if self._decode is None:
+            _, _, _, _, prefixes, suffixes = self.flat()
+            as_objects = lambda strings: np.array(strings, dtype=object)
+            plain = np.array([output == PH for output in self.outputs], dtype=bool)
+            self._decode = as_objects(self.outputs), as_objects(prefixes), as_objects(suffixes), plain
+        return self._decode
+
+    def transduce(self, syms:List[str], trace=None, counters=None) -> str:
+        """Runs a tokenized string through the table and returns the raw output tape (reserved symbols included)
+
+        Args:
+            syms (List[str]): input symbols
+            trace (collections.deque): if given, an (input symbol, state reached, output) entry is appended for every step,
+                followed by a (None, final state, final output) entry. Use a deque with a maxlen to bound its size
+            counters (instrumentation.Counters): if given, the transitions taken are counted
+        """
+        outputs = self.outputs
+        step = self.step
+        flat = self.flat() if trace is None else None
+
+        out = []
+        append = out.append
+        state = 0
+        if flat is not None:
+            _, _, next_cell, code, prefixes, suffixes = flat
+            ids = self.symbol_ids
+            cell = 0
+            if counters is None:
+                for sym in syms:
+                    idx = cell + ids.get(sym, 0)
+                    o = code[idx]
+                    cell = next_cell[idx]
+                    if o >= 0:
+                        append(outputs[o])
+                    else:
+                        append(prefixes[~o] + sym + suffixes[~o])
+            else:
+                # the transition taken is counted on its cell (PH transitions on column 0)
+                hits = counters.hits
+                for sym in syms:
+                    idx = cell + ids.get(sym, 0)
+                    o = code[idx]
+                    if o >= 0:
+                        hits[idx] += 1
+                        append(outputs[o])
+                    else:
+                        hits[cell] += 1
+                        append(prefixes[~o] + sym + suffixes[~o])
+                    cell = next_cell[idx]
+                counters.strings += 1
+            state = cell // len(self.symbols)
+        else:
+            num_syms = len(self.symbols)
+            hits = counters.hits if counters is not None else None
+            for sym, sid in zip(syms, self.encode(syms)):
+                prev = state
+                state, out_id, is_default = step(state, sid)
+                append(outputs[out_id].replace(PH, sym) if is_default else outputs[out_id])
+                if trace is not None:
+                    trace.append((sym, self.states[state], out[-1]))
+                if hits is not None:
+                    hits[prev * num_syms + (0 if is_default else sid)] += 1
+            if counters is not None:
+                counters.strings += 1
+
+        append(outputs[self.finals[state]])
+        if trace is not None:
+            trace.append((None, self.states[state], out[-1]))
+        return "".join(out)
+
+
+def compile_table(delta, finals, q0, rule_edges=None) -> "TransitionTable":
+    """Compiles delta into a TransitionTable
+
+    Args:
+        delta (defaultdict): transition function as returned by transitions.get_delta
+        finals (dict): final output mappings as returned by transitions.get_final_mappings
+        q0 (State): initial state
+        rule_edges (dict): optional (start state, insym) -> rule index mapping as returned by transitions.get_rule_edges
+
+    Returns:
+        TransitionTable: integer-indexed transition table
+    """
+
+    # q0 always gets ID 0 so the engine can start without a lookup
+    states = [q0] + [q for q in delta if q != q0]
+    state_ids = {q:i for i, q in enumerate(states)}
+
+    symbol_table = SymbolTable(sorted({sym for trans in delta.values() for sym in trans if sym != PH}))
+    symbols, symbol_ids = symbol_table.symbols, symbol_table.ids
+
+    outputs = []
+    output_ids = {}
+    def intern(string):
+        if string not in output_ids:
+            output_ids[string] = len(outputs)
+            outputs.append(string)
+        return output_ids[string]
+
+    default_next, default_out = array("i"), array("i")
+    row_ptr = array("i", [0])
+    sparse_syms, sparse_next, sparse_out = array("i"), array("i"), array("i")
+    dense_row, dense_next, dense_out = array("i"), array("i"), array("i")
+
+    for q in states:
+        trans = delta.get(q, {})
+
+        if trans.get(PH):
+            outsym, end = trans[PH]
+            default_next.append(state_ids[end])
+            default_out.append(intern(outsym))
+        else:
+            default_next.append(NO_EDGE)
+            default_out.append(NO_EDGE)
+
+        # empty entries can be left behind in delta by failed defaultdict lookups
+        edges = sorted((symbol_ids[sym], state_ids[t[1]], intern(t[0])) for sym, t in trans.items() if t and sym != PH)
+
+        if len(edges) >= DENSE_THRESHOLD * len(symbols):
+            dense_row.append(len(dense_next) // len(symbols))
+
+            row_next = [NO_EDGE] * len(symbols)
+            row_out = [NO_EDGE] * len(symbols)
+            for sym, nxt, out in edges:
+                row_next[sym] = nxt
+                row_out[sym] = out
+            dense_next.extend(row_next)
+            dense_out.extend(row_out)
+        else:
+            dense_row.append(NO_EDGE)
+
+            for sym, nxt, out in edges:
+                sparse_syms.append(sym)
+                sparse_next.append(nxt)
+                sparse_out.append(out)
+        row_ptr.append(len(sparse_syms))
+
+    finals_ids = array("i", [intern(finals.get(q, "")) for q in states])
+
+    if rule_edges is not None:
+        rule_edges = {(state_ids[q], symbol_ids[sym]):rule for (q, sym), rule in rule_edges.items() if q in state_ids and sym in symbol_ids}
+
+    table = TransitionTable([q.label for q in states], symbols, outputs, finals_ids,
+                            default_next, default_out,
+                            row_ptr, sparse_syms, sparse_next, sparse_out,
+                            dense_row, dense_next, dense_out, rule_edges)
+    return table
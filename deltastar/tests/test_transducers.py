@@ -1,11 +1,22 @@
+import asyncio
+import json
+import os
+import pickle
+import random
 import pytest
+import numpy as np
 import sys
 
 # technically not needed, but this lets me run the files through cmd 
 sys.path.append("/home/eric/python/projects/deltastar/") 
 sys.path.append("/home/eric/python/projects/deltastar/deltastar")
 
-from deltastar.transducers import assimilation, deletion, insertion
+from deltastar.transducers import DFST, Pipeline, assimilation, compile_many, compose, deletion, insertion
+from caching import CompileCache
+from cli import main as cli_main
+from server import RewriteServer
+import transitions as tr
+from utils.funcs import ContextError, RuleError, StorageError
 
 # the goal of these tests is to locate the inevitable edge cases that arise from certain combinations of contexts and mappings
 # (i.e., the mapping contains symbols also found in the context and vice versa, multiple contexts share the same syms, etc...)
@@ -667,4 +678,615 @@ class TestInsertion:
              "d d d p p y t t y m o p p t y m y t r r r m r"),
         ]
         for rewrite_sym, expected_sym in get_syms(fst, in_out_pairs):
-            assert rewrite_sym == expected_sym
\ No newline at end of file
+            assert rewrite_sym == expected_sym
+            
+class TestTransitionTable:
+    
+    def test_table_matches_delta(self):
+        
+        fst = assimilation([("a", "b"), ("x", "y")], ["a c a b _", "x y z _", "z z _"])
+        table = fst.table
+        for state, trans in fst.delta.items():
+            for insym, (outsym, end) in trans.items():
+                nxt, out, _ = table.step(table.states.index(state.label), table.symbol_ids[insym])
+                assert table.states[nxt] == end.label
+                assert table.outputs[out] == outsym
+                
+                
+    def test_unknown_symbols_take_placeholder(self):
+        
+        fst = deletion([("c", "")], ["a b _"])
+        table = fst.table
+        assert table.encode(["a", "q", "[TAG]"]) == [table.symbol_ids["a"], 0, 0]
+        assert fst.rewrite("q a b c q") == "q a b q"
+        
+        
+    def test_flat_cells_match_steps(self):
+        
+        fst = insertion([("", "[pl]")], ["d o g _", "c a t _"])
+        table = fst.table
+        next_cell, code, _, _, prefixes, suffixes = table.flat()
+        assert next_cell.dtype == code.dtype == np.int32
+        num_syms = len(table.symbols)
+        for state in range(len(table.states)):
+            for sid in range(num_syms):
+                nxt, out, is_default = table.step(state, sid)
+                cell = state * num_syms + sid
+                assert next_cell[cell] == nxt * num_syms
+                if is_default:
+                    assert table.outputs[out] == prefixes[~code[cell]] + "?" + suffixes[~code[cell]]
+                else:
+                    assert code[cell] == out
+        
+        strings = ["d o g", "c a t c a t ?", "[N] d o g"]
+        assert [table.transduce(fst._tokenize(s)) for s in strings] == table.transduce_many([fst._tokenize(s) for s in strings])
+
+
+class TestRewriteMany:
+    
+    def test_rewrite_many_matches_rewrite(self):
+        
+        fst = assimilation([("g", "G"), ("f", "F")], ["$ f g _ f y", "$ w _ p p", "b _ b"])
+        strings = [
+            "f g g f y f g g f y f g f g w f p p b b b g b g b g b f b f b",
+            "b b b f b g f b b f g g f y [test]",
+            "",
+            "w g p p",
+            "f g g f y f y f g f f y",
+        ]
+        assert fst.rewrite_many(strings) == [fst.rewrite(s) for s in strings]
+        
+        
+    def test_rewrite_many_insertion(self):
+        
+        fst = insertion([("", "t")], ["g _ t", "$ _ b", "$ m o _ h", "r o _ o r", "j _ k $"])
+        strings = ["b g g g g g t r r r f g r o o r", "m o h g g g t g t b r o r o m o h", "j k"]
+        assert [s.split() for s in fst.rewrite_many(strings)] == [
+            "t b g g g g g t t r r r f g r o t o r".split(),
+            "m o t h g g g t t g t t b r o r o m o h".split(),
+            "j t k".split(),
+        ]
+
+
+class TestParallel:
+    
+    def test_pickle_roundtrip(self):
+        
+        fst = deletion([("x", ""), ("y", ""), ("z", "")], ["_ y a y $", "_ x y z", "_ x x x y"])
+        copy = pickle.loads(pickle.dumps(fst))
+        assert copy.rewrite("x y a y x x x y x y z") == fst.rewrite("x y a y x x x y x y z")
+        
+        
+    def test_rewrite_parallel_keeps_order(self):
+        
+        fst = assimilation([("a", "b")], ["_ a b a b"])
+        strings = ["a a b a b b b a a b a a b a b", "b a b a a a a b a a b a b", "a b b a a b b a a a b a b a"] * 5
+        assert fst.rewrite_parallel(strings, workers=2, chunksize=4) == [fst.rewrite(s) for s in strings]
+        
+        
+class TestStreaming:
+    
+    def test_rewrite_stream_is_lazy(self):
+        
+        fst = assimilation([("a", "b")], ["c _"])
+        seen = []
+        def lines():
+            for line in ["c a\n", "a c a\n", "c c a\n"]:
+                seen.append(line)
+                yield line
+                
+        stream = fst.rewrite_stream(lines(), batch_size=1)
+        assert next(stream) == "c b"
+        assert len(seen) == 1
+        assert list(stream) == ["a c b", "c c b"]
+        
+        
+    def test_rewrite_file(self, tmp_path):
+        
+        fst = deletion([("x", "")], ["y _"])
+        in_path, out_path = tmp_path / "in.txt", tmp_path / "out.txt"
+        in_path.write_text("y x z\nx y x\n\ny y x\n", encoding="utf8")
+        
+        assert list(fst.rewrite_file(in_path, batch_size=2)) == ["y z", "x y", "", "y y"]
+        assert fst.rewrite_file(in_path, out_path, batch_size=2) == 4
+        assert out_path.read_text(encoding="utf8") == "y z\nx y\n\ny y\n"
+        
+        
+class TestRewriteCache:
+    
+    def test_rewrite_has_no_side_effects(self):
+        
+        fst = assimilation([("a", "b")], ["c _"], v0="[START]")
+        assert fst.rewrite("c a") == fst.rewrite("c a") == "[START] c b"
+        assert fst.v0 == "[START]"
+        
+        
+    def test_lru_counters(self):
+        
+        fst = assimilation([("a", "b")], ["c _"])
+        cache = fst.enable_cache(maxsize=2)
+        for s in ["c a", "c a", "a a", "c c a", "c a"]:
+            fst.rewrite(s)
+        
+        info = cache.info
+        assert (info["hits"], info["misses"], info["evictions"], info["size"]) == (1, 4, 2, 2)
+        assert fst.rewrite_many(["c a", "c c a", "c a", "a c a"]) == ["c b", "c c b", "c b", "a c b"]
+        assert cache.hits == 4
+        
+        
+class TestTrace:
+    
+    def test_trace_is_bounded(self):
+        
+        fst = assimilation([("a", "b")], ["a c _"])
+        trace = fst.trace("a c a x a a", size=3)
+        assert list(trace) == [("a", "a", "a"), ("$", "λ", "$"), (None, "λ", "")]
+        assert len(fst.trace("a " * 5000, size=10)) == 10
+        
+        
+class TestStorage:
+    
+    @pytest.mark.parametrize("mmap", [True, False])
+    def test_save_load_roundtrip(self, tmp_path, mmap):
+        
+        fst = insertion([("", "[tns=pst]")], ["e d _ $", "p o p _ p o p", "x y z _ x y z"], v0="[V]")
+        fst.save(tmp_path / "machine.dfst")
+        loaded = DFST.load(tmp_path / "machine.dfst", mmap=mmap)
+        
+        strings = ["v e r b e d", "x x x x y z x y z p o p p o p e d", "a b c"]
+        assert loaded.rules == fst.rules and loaded.rule_type == "insertion"
+        assert [loaded.rewrite(s) for s in strings] == [fst.rewrite(s) for s in strings]
+        assert loaded.rewrite_many(strings) == fst.rewrite_many(strings)
+        
+        # the flat form is read from the file rather than rebuilt
+        next_cell, code = loaded.table.flat()[:2]
+        assert not next_cell.flags.owndata and not code.flags.owndata
+        assert (next_cell == fst.table.flat()[0]).all() and (code == fst.table.flat()[1]).all()
+        assert pickle.loads(pickle.dumps(loaded)).rewrite(strings[0]) == fst.rewrite(strings[0])
+        
+        
+    def test_load_rejects_other_files(self, tmp_path):
+        
+        path = tmp_path / "not_a_machine"
+        path.write_bytes(b"hello world, this is not a machine")
+        with pytest.raises(StorageError):
+            DFST.load(path)
+        
+        
+class TestCompileCache:
+    
+    def test_cache_hit_returns_compiled_machine(self, tmp_path, monkeypatch):
+        
+        fst = deletion([("x", ""), ("y", "")], ["_ y a y $", "_ x y z"], cache_dir=tmp_path)
+        assert len(list(tmp_path.iterdir())) == 1
+        
+        # a hit must not compile anything
+        monkeypatch.setattr("transitions.get_transitions", None)
+        cached = deletion([("x", ""), ("y", "")], ["_  y a y $", "_ x y z"], v0="[V]", cache_dir=str(tmp_path))
+        assert cached.delta.keys() == fst.delta.keys()
+        assert cached.rewrite("x y a y x y z") == "[V] " + fst.rewrite("x y a y x y z")
+        
+        
+    def test_eviction_by_size_and_age(self, tmp_path):
+        
+        cache = CompileCache(tmp_path, max_age=60)
+        for con in ["a _", "b _", "c _"]:
+            assimilation([("x", "y")], [con], cache_dir=cache)
+        entries = sorted(tmp_path.iterdir())
+        assert len(entries) == 3
+        
+        old = entries[0]
+        os.utime(old, (0, 0))
+        assert cache.evict() == 1 and not old.exists()
+        
+        cache.max_bytes = max(p.stat().st_size for p in tmp_path.iterdir())
+        assert cache.evict() == 1
+        assert len(list(tmp_path.iterdir())) == 1
+        
+        
+class TestMinimize:
+    
+    @pytest.mark.parametrize("fst", [
+        assimilation([("a", "b"), ("x", "y")], ["a c a b _", "x y z _"]),
+        assimilation([("g", "G"), ("f", "F")], ["$ f g _ f y", "$ w _ p p", "b _ b"]),
+        deletion([("f", ""), ("c", "")], ["_ c c c $", "_ p f a $", "_ o f", "_ o o p"]),
+        insertion([("", "t")], ["g _ t", "$ _ b", "$ m o _ h", "r o _ o r", "j _ k $"]),
+    ])
+    def test_minimize_preserves_rewrites(self, fst):
+        
+        symbols = sorted(set(sym for sym in fst.table.symbols if sym not in ["?", "$", "Ø"])) + ["q"]
+        rng = random.Random(0)
+        strings = [" ".join(rng.choice(symbols) for _ in range(rng.randint(0, 12))) for _ in range(300)]
+        expected = [fst.rewrite(s) for s in strings]
+        
+        report = fst.minimize()
+        assert [fst.rewrite(s) for s in strings] == expected
+        assert fst.sigma == set(sym for trans in fst.delta.values() for sym in trans)
+        assert report["states_after"] == len(fst.delta) <= report["states_before"]
+        assert report["states_removed"] == report["unreachable_states"] + report["merged_states"]
+        assert fst.minimize()["states_removed"] == 0
+        
+        
+class TestCompose:
+    
+    def test_compose_cascade(self):
+        
+        nasal_place_assim = assimilation([("n", "ŋ")], ["_ k", "_ g"])
+        post_nasal_vce = assimilation([("t", "d"), ("p", "b"), ("k", "g")], ["m _", "ŋ _"])
+        final_devoicing = deletion([("g", "")], ["_ $"], v0="[V]")
+        insert_tag = insertion([("", "[pl]")], ["s _ $"])
+        
+        cascade = [nasal_place_assim, post_nasal_vce, final_devoicing, insert_tag]
+        fst = compose(*cascade)
+        strings = ["b a n k", "a n k a m p", "s i n k s", "", "[T] n g", "m a t k n k s"]
+        for s in strings:
+            expected = s
+            for machine in cascade:
+                expected = machine.rewrite(expected)
+            assert fst.rewrite(s).split() == expected.split()
+        assert fst.rewrite_many(strings) == [fst.rewrite(s) for s in strings]
+        
+    def test_compose_unknown_multicharacter_symbols(self, tmp_path):
+        
+        first, second = assimilation([("a", "b")], ["c _"]), assimilation([("o", "X")], ["f _"])
+        fst = compose(first, second)
+        assert fst.rewrite("h e l l o f o") == second.rewrite(first.rewrite("hello fo")) == "h e l l o f X"
+        assert fst.rewrite("[T] c a") == "[T] c b"
+        
+        fst.save(tmp_path / "composed.dfst")
+        for machine in (fst, DFST.load(tmp_path / "composed.dfst"), Pipeline([fst])):
+            with pytest.raises(ValueError, match="symbol 'hello'"):
+                machine.rewrite("hello fo")
+        
+        
+class TestPipeline:
+    
+    def test_pipeline_matches_cascade(self):
+        
+        cascade = [
+            assimilation([("n", "ŋ")], ["_ k", "_ g"]),
+            insertion([("", "[pl]")], ["s _ $"], v0="[W]"),
+            assimilation([("t", "d"), ("p", "b"), ("k", "g")], ["m _", "ŋ _"]),
+            deletion([("g", "")], ["_ $"]),
+        ]
+        pipeline = Pipeline(cascade)
+        strings = ["b a n k", "a n k a m p", "s i n k s", "", "[T] n g", "m a t k n k s"]
+        expected = []
+        for s in strings:
+            for machine in cascade:
+                s = machine.rewrite(s)
+            expected.append(" ".join(s.split()))
+            
+        assert [pipeline.rewrite(s) for s in strings] == expected
+        assert pipeline.rewrite_many(strings) == expected
+        assert list(pipeline.rewrite_stream(strings, batch_size=4)) == expected
+        assert len(pipeline.stats) == 4 and all(stage["seconds"] > 0 for stage in pipeline.stats)
+        
+        
+class TestSymbolTable:
+    
+    def test_symbol_table_interns_tags(self):
+        
+        fst = insertion([("", "[tns=pst]")], ["e d _ $", "p o p _ p o p"])
+        symbols = fst.symbol_table
+        assert "[tns=pst]" in symbols and "e" in symbols
+        assert symbols.encode(["e", "d"]) == fst.table.encode(["e", "d"])
+        
+        ids = symbols.tokenize("v e r b e d[tns=pst]", spaced=False)
+        assert symbols.decode(ids) == ["?", "e", "?", "?", "e", "d", "[tns=pst]"]
+        assert symbols.tokenize("e d [tns=pst] [x]") == [symbols.id("e"), symbols.id("d"), symbols.id("[tns=pst]"), 0]
+        
+        
+class TestCompileTimes:
+    
+    def test_from_rules_records_phases(self):
+        
+        fst = assimilation([("a", "b")], ["a c _", "c c _"])
+        assert set(fst.compile_times) == {"context_transitions", "prefix_transitions", "delta", "Q_sigma_gamma_finals", "table"}
+        assert all(seconds >= 0 for seconds in fst.compile_times.values())
+
+
+class TestInstrumentation:
+    
+    def test_counts_rules_states_and_fallbacks(self, tmp_path):
+        
+        fst = assimilation([("n", "m"), ("t", "d")], ["_ p", "_ b"])
+        strings = ["a n p a", "t b", "n b n p x"]
+        counters = fst.instrument()
+        for s in strings:
+            fst.rewrite(s)
+        snapshot = counters.snapshot()
+        
+        assert snapshot["rule_fires"] == {"n -> m / _ p": 2, "t -> d / _ p": 0, "n -> m / _ b": 1, "t -> d / _ b": 1}
+        assert snapshot["strings"] == 3 and snapshot["steps"] == 17
+        assert snapshot["fallback_rate"] == 9 / 17
+        assert sum(snapshot["state_visits"].values()) == 17
+        
+        # the vectorized path counts the same things
+        counters.reset()
+        assert counters.snapshot()["steps"] == 0
+        fst.rewrite_many(strings)
+        assert counters.snapshot() == snapshot
+        
+        # rule attribution survives minimization and saving
+        fst.minimize()
+        fst.save(tmp_path / "machine.dfst")
+        for machine in (fst, DFST.load(tmp_path / "machine.dfst")):
+            counters = machine.instrument()
+            machine.rewrite_many(strings)
+            assert counters.snapshot()["rule_fires"] == snapshot["rule_fires"]
+        
+        fst.disable_instrumentation()
+        assert fst.rewrite("n p") == "m p"
+        
+    def test_composed_machines_dont_report_rule_fires(self):
+        
+        fst = compose(assimilation([("n", "m")], ["_ p"]), deletion([("m", "")], ["_ p"]))
+        counters = fst.instrument()
+        assert fst.rewrite("a n p") == "a p"
+        snapshot = counters.snapshot()
+        assert counters.rule_fires is None and snapshot["rule_fires"] is None
+        assert snapshot["strings"] == 1 and snapshot["steps"] == 5
+
+
+class TestLazy:
+    
+    def test_lazy_matches_compiled(self, tmp_path):
+        
+        contexts = ["a _ b", "x y _ z", "b _ b c"]
+        fst = assimilation([("c", "d"), ("b", "p")], contexts)
+        lazy = assimilation([("c", "d"), ("b", "p")], contexts, lazy=True, max_states=3)
+        assert lazy.lazy and not lazy.delta
+        
+        strings = ["a c b", "x y b z a b b", "b c b c q", "[T] a b b c"]
+        assert [lazy.rewrite(s) for s in strings] == [fst.rewrite(s) for s in strings]
+        assert lazy.rewrite_many(strings) == fst.rewrite_many(strings)
+        
+        info = lazy.table.info
+        assert info["expanded"] <= 3 and info["evictions"] > 0
+        
+        # operations that need the whole machine compile it first
+        lazy.save(tmp_path / "machine.dfst")
+        assert not lazy.lazy and lazy.delta
+        assert DFST.load(tmp_path / "machine.dfst").rewrite_many(strings) == fst.rewrite_many(strings)
+        
+    def test_eviction_is_least_recently_used(self):
+        
+        table = assimilation([("c", "d")], ["a b _"], lazy=True, max_states=2).table
+        table.expand("λ")
+        table.expand("a")
+        table.transduce(["q"]) # reads λ's row again
+        table.expand("ab")
+        assert list(table.rows) == ["λ", "ab"] and table.info["evictions"] == 1
+
+
+
+class TestEdgeSet:
+    
+    def test_shared_prefixes_are_built_once(self):
+        
+        insyms, outsyms = ["x", "y", "z"], ["X", "Y", "Z"]
+        edges = tr.context_transitions(insyms, outsyms, ["a b _", "a c _"])
+        
+        # λ -a-> a, a -b-> ab and a -c-> ac (each with a PH edge), and the three mappings at both leaves
+        assert len(edges) == 13
+        assert sum(t.is_transduction for t in edges) == 6
+        
+        fst = assimilation(list(zip(insyms, outsyms)), ["a b _", "a c _"])
+        assert fst.rewrite("a b x a c z a x") == "a b X a c Z a x"
+        
+        
+    def test_failure_links_only_reach_real_states(self):
+        
+        context_trans = tr.context_transitions(["c"], ["d"], ["a b a _", "b b _"])
+        index = tr.prefix_index(context_trans, {})
+        assert tr.failure_links("aba", index) == ["a", ""] # "ba" is not followed by any state
+        assert tr.failure_links("bb", index) == ["b", ""]
+        
+        # every prefix transition ends in an existing state
+        for q in index["Q"]:
+            for t in tr.state_prefix_transitions(q, index):
+                assert t.end.label in index["Q_labels"]
+
+
+class TestAddRemoveRule:
+    
+    def test_add_rule_matches_full_build(self):
+        
+        fst = assimilation([("c", "d")], ["a _", "x y _"])
+        fst.enable_cache()
+        assert fst.rewrite("b c a c") == "b c a d"
+        
+        fst.add_rule(("b", "p"), "a _")
+        assert fst.rewrite("a b x y b") == "a p x y b"
+        report = fst.add_rule(("b", "p"), "x y  _")
+        assert report["rebuilt_states"] < report["states"]
+        
+        expected = assimilation([("c", "d"), ("b", "p")], ["a _", "x y _"])
+        assert fst.rewrite("b c a c") == "b c a d"
+        for s in ["a b a c", "x y b x y c", "b b a b"]:
+            assert fst.rewrite(s) == expected.rewrite(s)
+        assert sorted(fst.rules) == sorted(expected.rules)
+        
+        
+    def test_remove_rule(self):
+        
+        fst = deletion([("c", ""), ("d", "")], ["_ a b", "_ b"])
+        fst.remove_rule(("d", ""), "_ a b")
+        assert fst.rewrite("d a b c b d b") == "d a b b b"
+        assert "d -> Ø / _ a b" not in fst.rules
+        
+        with pytest.raises(RuleError):
+            fst.remove_rule(("d", ""), "_ a b")
+        with pytest.raises(ContextError):
+            fst.add_rule(("c", ""), "a _")
+        
+        
+    def test_insertion_and_context_free(self):
+        
+        fst = insertion([("", "[pl]")], ["d o g _"])
+        fst.add_rule(("", "[pl]"), "c a t _")
+        assert fst.rewrite("c a t d o g") == "c a t [pl] d o g [pl]"
+        with pytest.raises(ValueError):
+            fst.add_rule(("", "[sg]"), "c a t _")
+        
+        cf = assimilation([("a", "b")])
+        cf.add_rule(("c", "d"))
+        assert cf.rewrite("a c e") == "b d e"
+
+
+
+class TestServer:
+    
+    def test_requests_are_batched(self, tmp_path):
+        
+        fst = assimilation([("n", "m")], ["_ p"])
+        server = RewriteServer({"nasal": fst, "deletion": deletion([("c", "")], ["a b _"])}, max_batch=8, max_wait=0.2)
+        strings = [f"a n p {i}" for i in range(10)]
+        
+        async def main():
+            await server.start(path=str(tmp_path / "deltastar.sock"))
+            try:
+                outputs = await asyncio.gather(*(server.rewrite(s, "nasal") for s in strings))
+                
+                reader, writer = await asyncio.open_unix_connection(str(tmp_path / "deltastar.sock"))
+                requests = [{"id": 1, "machine": "deletion", "text": "a b c"}, {"id": 2, "machine": "other", "text": "a"}]
+                writer.write(b"".join(json.dumps(r).encode("utf8") + b"\n" for r in requests))
+                await writer.drain()
+                responses = [json.loads(await reader.readline()) for _ in requests]
+                writer.close()
+            finally:
+                await server.close()
+            return outputs, responses
+        
+        outputs, responses = asyncio.run(main())
+        assert outputs == fst.rewrite_many(strings)
+        assert server.stats["requests"] == 11 and server.stats["batches"] == 3 # 8 + 2 strings, then the socket request
+        assert responses[0] == {"id": 1, "text": "a b"}
+        assert responses[1]["id"] == 2 and "unknown machine" in responses[1]["error"]
+        
+    def test_bad_request_only_fails_itself(self, tmp_path):
+        
+        fst = compose(assimilation([("n", "m")], ["_ p"]), deletion([("m", "")], ["_ p"]))
+        server = RewriteServer({"composed": fst}, max_batch=8, max_wait=0.2)
+        
+        async def main():
+            await server.start(path=str(tmp_path / "deltastar.sock"))
+            try:
+                return await asyncio.gather(server.rewrite("a n p"), server.rewrite("hello fo"), server.rewrite(5),
+                                            server.rewrite("n p"), return_exceptions=True)
+            finally:
+                await server.close()
+        
+        good, unknown, not_text, other = asyncio.run(main())
+        assert (good, other) == ("a p", "p")
+        assert isinstance(unknown, ValueError) and isinstance(not_text, TypeError)
+        assert server.stats["batches"] == 1
+
+
+
+class TestCli:
+    
+    def test_rewrite_rule_file_and_saved_machine(self, tmp_path, capsys):
+        
+        rules = [{"type": "assimilation", "pairs": [["t", "d"]], "contexts": ["a _ a"]},
+                 {"type": "deletion", "pairs": [["d", ""]], "contexts": ["a _"]}]
+        (tmp_path / "rules.json").write_text(json.dumps(rules), encoding="utf8")
+        strings = [" ".join(random.Random(i).choice("atdb") for _ in range(6)) for i in range(50)]
+        (tmp_path / "in.txt").write_text("".join(s + "\n" for s in strings), encoding="utf8")
+        expected = Pipeline([assimilation([("t", "d")], ["a _ a"]), deletion([("d", "")], ["a _"])]).rewrite_many(strings)
+        
+        for workers in ("1", "2"):
+            assert cli_main(["rewrite", str(tmp_path / "rules.json"), "-i", str(tmp_path / "in.txt"), "-o", str(tmp_path / "out.txt"),
+                             "-w", workers, "-c", "7", "--stats"]) == 0
+            assert (tmp_path / "out.txt").read_text(encoding="utf8").splitlines() == expected
+            assert "50 lines, 300 tokens" in capsys.readouterr().err
+        
+        assert cli_main(["compile", str(tmp_path / "rules.json"), "-o", str(tmp_path / "machine.dfst")]) == 1
+        assert cli_main(["compile", str(tmp_path / "rules.json"), "-o", str(tmp_path / "machine.dfst"), "--compose"]) == 0
+        assert cli_main(["rewrite", str(tmp_path / "machine.dfst"), "-i", str(tmp_path / "in.txt"), "-o", str(tmp_path / "out.txt")]) == 0
+        assert (tmp_path / "out.txt").read_text(encoding="utf8").splitlines() == expected
+
+
+class TestGraphs:
+    
+    def test_export_and_filters(self, tmp_path):
+        
+        fst = assimilation([("a", "b")], ["c _"])
+        assert fst.to_graph(tmp_path / "machine.dot", show_PH=True) == 5
+        dot = (tmp_path / "machine.dot").read_text(encoding="utf8")
+        assert dot.count(" -> ") == 6 and dot.count("[label=") == 7 # 5 edges and the initial arrow, 2 states
+        assert '1 -> 0 [label="a:b"];' in dot
+        
+        assert fst.to_graph(tmp_path / "machine.json") == 3
+        assert fst.to_graph(tmp_path / "machine.json", states=["λ"], radius=0) == 0
+        
+        with pytest.raises(ValueError):
+            fst.to_graph(tmp_path / "machine.json", top=1)
+        fst.instrument()
+        fst.rewrite_many(["c a c a", "c a"])
+        fst.rewrite("c c")
+        assert fst.to_graph(tmp_path / "machine.json", top=2) == 2 # c:c out of c was only taken once
+        graph = json.loads((tmp_path / "machine.json").read_text(encoding="utf8"))
+        assert graph["edges"] == [{"start": 0, "end": 1, "in": "c", "out": "c", "count": 4}, {"start": 1, "end": 0, "in": "a", "out": "b", "count": 3}]
+        assert [state["label"] for state in graph["states"]] == ["λ", "c"]
+        
+        with pytest.raises(ValueError):
+            fst.to_graph(tmp_path / "machine.gif")
+
+
+class TestCompactTransitions:
+    
+    def test_states_are_interned_and_edges_columnar(self):
+        
+        assert tr.State("ab") is tr.State("ab") and tr.State("ab")[1:] == "b"
+        assert pickle.loads(pickle.dumps(tr.State("ab"))) is tr.State("ab")
+        with pytest.raises(AttributeError):
+            tr.State("ab").label = "ba"
+        
+        fst = assimilation([("c", "d")], ["a b a _", "b b _"])
+        assert all(q is tr.State(q.label) for q in fst.delta)
+        
+        context_trans = tr.context_transitions(["c"], ["d"], ["a b a _", "b b _"])
+        index = tr.prefix_index(context_trans, {})
+        edges = tr.prefix_transitions(context_trans, {})
+        assert isinstance(edges, tr.Edges) and len(edges) == len(list(edges))
+        assert list(edges) == [t for q in index["Q"] for t in tr.state_prefix_transitions(q, index)]
+        assert edges[0] == next(iter(edges))
+
+
+
+class TestCompileMany:
+    
+    def test_results_in_order_with_errors(self):
+        
+        definitions = [
+            {"type": "assimilation", "pairs": [["n", "m"]], "contexts": ["_ p", "_ b"]},
+            {"type": "deletion", "pairs": [["c", ""]], "contexts": ["a b _"]},
+            {"type": "insertion", "pairs": [["", "x"]], "contexts": ["a _ b"], "v0": "#"},
+            {"type": "deletion", "pairs": [["c", "d"]]},
+            {"type": "metathesis", "pairs": [["a", "b"]]},
+        ]
+        expected = [assimilation([("n", "m")], ["_ p", "_ b"]), deletion([("c", "")], ["a b _"]), insertion([("", "x")], ["a _ b"], v0="#")]
+        
+        for workers in (1, 2):
+            results = compile_many(definitions, workers=workers)
+            assert [result.index for result in results] == [0, 1, 2, 3, 4]
+            assert [result.ok for result in results] == [True, True, True, False, False]
+            for result, fst in zip(results, expected):
+                assert result.machine.rewrite_many(["a n p a b c", "a b"]) == fst.rewrite_many(["a n p a b c", "a b"])
+                assert result.seconds > 0 and "table" in result.compile_times
+            assert isinstance(results[3].error, RuleError) and results[3].machine is None
+            assert "unknown rule type" in str(results[4].error)
+        
+        with pytest.raises(RuleError):
+            compile_many(definitions, workers=2, raise_errors=True)
+        
+    def test_malformed_definitions(self):
+        
+        for workers in (1, 2):
+            results = compile_many([[1], {"pairs": [["t", "d"], ["t"]]}, {"pairs": [["t", "d"]], "contexts": [3]}], workers=workers)
+            assert all(isinstance(result.error, RuleError) for result in results)
+            assert str(results[0].error).startswith("rule set 0: a rule set definition must be an object")
+            assert str(results[1].error) == "rule set 1: pair 1 must be an [input, output] pair, not ['t']"
+            assert str(results[2].error) == "rule set 2: context 0 must be a string, not 3"
@@ -1,15 +1,26 @@
     # -*- coding: utf8 -*-
 
 # Eric Sclafani
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
-import pydot
+import time
 import transitions as tr
+import tables
+import storage
+import minimization
+import composition
+import graphs
+import incremental
+from pipeline import Pipeline
+from functools import reduce
+from caching import CompileCache, RewriteCache
+from instrumentation import Counters
+from lazy import LazyTable, MAX_STATES
+from symbols import SymbolTable
 from utils.funcs import *
-from typing import List
-from tabulate import tabulate 
+from typing import Iterable, Iterator, List
 
-RESERVED = ["$", "λ", "Ø", "?"]
 
 @dataclass
 class DFST:
@@ -23,10 +34,26 @@ class DFST:
     rule_type:str
     v0:str = ""
     q0:str = tr.State("λ")
+    table:tables.TransitionTable = None
+    cache:RewriteCache = None
+    compile_times:dict = None # seconds spent in each phase of from_rules
+    counters:Counters = None
+    spec:List[tuple] = None # (insym, outsym, context) of every rule, in the order of rules. Needed by add_rule and remove_rule
+    composed:bool = False # built by compose, which restricts the unknown symbols it can read (see composition.check_symbols)
+    
+    def __getstate__(self):
+        # the context transitions kept around by add_rule and remove_rule are only a cache
+        state = self.__dict__.copy()
+        state.pop("_build", None)
+        return state
+    
     
     @property                    
     def displayparams(self):
         """ Prints rewrites rule, sigma, gamma, Q, q0, v0, F, delta""" 
+        from tabulate import tabulate # only needed for display, so services that never display don't import it
+        
+        self.materialize()
         finals = {f"<{k}>":v for k,v in self.finals.items()}
         
         print(f"{'~'*7}Rewrite rules:{'~'*7}")
@@ -59,133 +86,587 @@ class DFST:
     
     
     
-    def to_graph(self, file_name="my_machine.png", show_PH=False):
-        """Creates a .png file of you machine via Graphviz and saves to local directory
+    @property
+    def symbol_table(self) -> SymbolTable:
+        """Symbol table of every input and output symbol of the machine. Input symbols keep the IDs the transition table uses"""
+        
+        self.materialize()
+        self._ensure_table()
+            
+        symbols = SymbolTable(self.table.symbols[1:])
+        for output in self.table.outputs:
+            for sym in split_symbols(output.translate(STRIP_RESERVED)):
+                symbols.add(sym)
+        return symbols
+    
+    
+    
+    def to_graph(self, file_name="my_machine.png", show_PH=False, states:List[str]=None, radius=1, top:int=None) -> int:
+        """Exports a graph of your machine. Each state and transition is written once, straight to the file
         
         Args:
-            file_name (str): name of the file. Defaults to 'my_machine.png'
-            show_PH (bool): option to show the ?:? transitions. Set to False by default to avoid clutter"""
-         
-        if not file_name.endswith(".png"):
-            raise ValueError("only .png files can be exported")
-        
-        graph = pydot.Dot("finite_state_machine", graph_type="digraph", rankdir="LR", size="10!")
-        graph.add_node(pydot.Node("initial", shape="point", color="white"))
-        
-        i = 0
-        for state, transitions in self.delta.items():
-            for in_sym, out_trans in transitions.items():
-                
-                if not show_PH and in_sym == PH:
-                    continue
-                
-                start = state
-                end = out_trans[1]
-                
-                if start == self.q0 and i == 0: # i enforces that this edge only gets created once
-                    graph.add_edge(pydot.Edge("initial", str(start)))
-                
-                if self.finals[start]:
-                    start = f"{start}\\,{self.finals[start]}"
-                        
-                if self.finals[end]:
-                    end = f"{end}\\,{self.finals[end]}"
-                          
-                graph.add_node(pydot.Node(str(start), shape="doublecircle"))
-                graph.add_node(pydot.Node(str(end), shape="doublecircle"))
-                graph.add_edge(pydot.Edge(str(start), str(end), label=f"{in_sym}\\:{out_trans[0]}"))
-                i += 1
-                
-        graph.write_png(file_name)
+            file_name (str): name of the file. Its extension picks the format: .png or .svg (rendered by Graphviz),
+                .dot (Graphviz source) or .json. Defaults to 'my_machine.png'
+            show_PH (bool): option to show the ?:? transitions. Set to False by default to avoid clutter
+            states (List[str]): only draw the states at most radius transitions away from these states
+            radius (int): how far the graph reaches out from states
+            top (int): only draw the top most taken transitions. Requires an instrumented machine (see DFST.instrument).
+                Transitions of an instrumented machine are labeled with how often they were taken
+            
+        Returns:
+            int: number of transitions drawn
+        """
+        self.materialize()
+        self._ensure_table()
+        return graphs.export(self.table, file_name, states, radius, show_PH, top, self.counters)
     
     
-    #! add a better debug mode
-    def rewrite(self, s:str, show_path=False) -> str:
-        """Rewrite a user's target string by iterating through delta and producing an output tape
+    def rewrite(self, s:str, show_path=False, trace_size=1000) -> str:
+        """Rewrite a user's target string by iterating through the transition table and producing an output tape
         
         Args:
             s (str): string to undergo transduction
             show_path (bool): debug option to see the output tape and path the string takes through the machine (can get messy with large machines)
+            trace_size (int): maximum number of steps shown by show_path (only the most recent ones are kept)
             
         Returns:
             str: new string
         """
         
-        path = []
-        out_tape = []
-        output = ""
-        state = self.q0 # begin at the initial state
+        if show_path:
+            trace = self.trace(s, trace_size)
+            print(f"\nInput string: {' '.join(sym for sym, _, _ in trace if sym is not None)}")
+            print(f"String path: {' --> '.join(state for _, state, _ in trace)}")
+            print(f"Output tape: {' --> '.join(out for _, _, out in trace)}")
         
-        if self.rule_type == "insertion":
-            s = list("$"+ "Ø" + intersperse(s.split(), "Ø") + "Ø" + "$")
-        else:
-            s = ("$ " + s + " $").split()
+        if self.cache is not None:
+            cached = self.cache.get(s)
+            if cached is not None:
+                return cached
             
-        for sym in s: 
-            try: # attempt to find transitions
-                outsym = self.delta[state][sym][0] 
-                output += outsym 
-                state = self.delta[state][sym][1]
-                path.append(state.label)
-                
-            except KeyError: # if not found, use the placeholder transition and replace placeholder with sym
-                outsym = self.delta[state][PH][0]
-                output += outsym.replace(PH, sym)
-                state = self.delta[state][PH][1]
-                path.append(state.label)
-            out_tape.append(output)
+        self._ensure_table()
+        
+        output = self._finish(self.table.transduce(self._tokenize(s), counters=self.counters))
+        if self.cache is not None:
+            self.cache.put(s, output)
+        return output
+    
+    
+    def trace(self, s:str, size=1000) -> deque:
+        """Records the steps a string takes through the machine into a ring buffer
+        
+        Args:
+            s (str): string to undergo transduction
+            size (int): maximum number of steps kept. Older steps are dropped as new ones are recorded
             
-        output += self.finals[state]
-        out_tape.append(output)
+        Returns:
+            deque: (input symbol, state reached, output) entries, ending with a (None, final state, final output) entry
+        """
+        self._ensure_table()
+            
+        trace = deque(maxlen=size)
+        self.table.transduce(self._tokenize(s), trace)
+        return trace
+    
+    
+    def rewrite_many(self, strings:List[str]) -> List[str]:
+        """Rewrite many strings at once. All strings are stepped through the transition table together with numpy
         
-        for sym in RESERVED:
-            output = output.replace(sym, "").strip()
+        Args:
+            strings (List[str]): strings to undergo transduction
             
-        if show_path:
-            print(f"\nInput string: {' '.join(s)}")
-            print(f"String path: {' --> '.join(path)}\nOutput tape: {' --> '.join(out_tape)}")
+        Returns:
+            List[str]: new strings, in the same order as the input
+        """
+        self._ensure_table()
+            
+        if self.cache is None:
+            outputs = self.table.transduce_many([self._tokenize(s) for s in strings], self.counters)
+            return [self._finish(output) for output in outputs]
+        
+        # only strings missing from the cache get simulated (each distinct one once)
+        results = [self.cache.get(s) for s in strings]
+        misses = list(dict.fromkeys(s for s, r in zip(strings, results) if r is None))
+        outputs = self.table.transduce_many([self._tokenize(s) for s in misses], self.counters)
+        new = {s:self._finish(output) for s, output in zip(misses, outputs)}
+        for s, output in new.items():
+            self.cache.put(s, output)
+        return [new[s] if r is None else r for s, r in zip(strings, results)]
+    
+    
+    def enable_cache(self, maxsize=100_000) -> RewriteCache:
+        """Turns on memoization of rewrites with a bounded LRU cache (replacing any existing one)
+        
+        Args:
+            maxsize (int): maximum number of cached strings before the least recently used ones are evicted
+            
+        Returns:
+            RewriteCache: the new cache, whose info property reports hits, misses and evictions
+        """
+        self.cache = RewriteCache(maxsize)
+        return self.cache
+    
+    
+    def disable_cache(self):
+        self.cache = None
+    
+    
+    def instrument(self) -> Counters:
+        """Turns on counting of state visits, rule firings and PH (any other symbol) transitions for every rewrite 
+        (replacing any existing counters). Rewrites answered by the cache are not counted
+        
+        Returns:
+            Counters: the new counters. Use snapshot() to read them and reset() to zero them
+        """
+        self.materialize()
+        self._ensure_table()
+        self.counters = Counters(self.table, self.rules)
+        return self.counters
+    
+    
+    def disable_instrumentation(self):
+        self.counters = None
+    
+    
+    def rewrite_stream(self, lines:Iterable[str], batch_size=1024) -> Iterator[str]:
+        """Lazily rewrite an iterable of strings (e.g. an open file). At most batch_size strings are held in memory at once
+        
+        Args:
+            lines (Iterable[str]): strings to undergo transduction. Trailing newlines are removed
+            batch_size (int): number of strings rewritten together with rewrite_many. Use 1 for interactive input
+            
+        Yields:
+            str: new strings, in the same order as the input
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
         
-        self.v0 = self.v0 + " " if self.v0 else ""
-        return intersperse(self.v0 + output)
+        batch = []
+        for line in lines:
+            batch.append(line.rstrip("\n"))
+            if len(batch) == batch_size:
+                yield from self.rewrite_many(batch)
+                batch = []
+        if batch:
+            yield from self.rewrite_many(batch)
+    
     
+    def rewrite_file(self, in_path:str, out_path:str=None, batch_size=1024, buffer_size=1<<20, encoding="utf8"):
+        """Rewrite a file line by line without loading it into memory
+        
+        Args:
+            in_path (str): file to read strings from, one per line
+            out_path (str): file to write the new strings to. If not given, the new strings are yielded instead
+            batch_size (int): number of lines rewritten together with rewrite_many
+            buffer_size (int): size in bytes of the output write buffer
+            encoding (str): encoding of both files
+            
+        Returns:
+            int | Iterator[str]: number of lines written, or a generator of new strings if out_path is not given
+        """
+        rewrites = self.rewrite_stream(read_lines(in_path, encoding), batch_size)
+        if out_path is None:
+            return rewrites
+        
+        count = 0
+        with open(out_path, "w", encoding=encoding, buffering=buffer_size) as f:
+            for line in rewrites:
+                f.write(line + "\n")
+                count += 1
+        return count
+    
+    
+    def rewrite_parallel(self, strings:List[str], workers=None, chunksize=1024) -> List[str]:
+        """Rewrite many strings across a pool of worker processes. Each worker receives a compiled copy of the machine once
+        and rewrites whole chunks of strings with rewrite_many
+        
+        Args:
+            strings (List[str]): strings to undergo transduction
+            workers (int): number of worker processes. Defaults to the number of CPUs
+            chunksize (int): number of strings sent to a worker at a time
+            
+        Returns:
+            List[str]: new strings, in the same order as the input
+        """
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1")
+        
+        chunks = [strings[i:i+chunksize] for i in range(0, len(strings), chunksize)]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(self.compiled(),)) as pool:
+            return [output for chunk in pool.map(_rewrite_chunk, chunks) for output in chunk]
+    
+    
+    @property
+    def lazy(self) -> bool:
+        """Whether the machine expands its states on demand (see DFST.from_rules)"""
+        return isinstance(self.table, LazyTable)
+    
+    
+    def materialize(self) -> "DFST":
+        """Fully compiles a lazy machine in place, building every state and prefix transition. 
+        Graphing, minimizing, composing, saving and instrumenting need the full machine and call this first
+        
+        Returns:
+            DFST object: the machine itself
+        """
+        if self.lazy:
+            full = type(self).from_spec(self.table.spec, self.rules, v0=self.v0, rule_type=self.rule_type)
+            self.delta, self.Q, self.sigma, self.gamma, self.finals = full.delta, full.Q, full.sigma, full.gamma, full.finals
+            self.table, self.compile_times = full.table, full.compile_times
+        return self
+    
+    
+    def compiled(self) -> "DFST":
+        """Returns a copy of the machine that only holds what rewriting needs (the transition table). 
+        It is cheap to pickle and send to other processes, but cannot be displayed or graphed"""
+        
+        self._ensure_table()
+        return DFST({}, [], set(), set(), {}, self.rules, self.rule_type, v0=self.v0, q0=self.q0, table=self.table, composed=self.composed)
+    
+    
+    def minimize(self) -> dict:
+        """Minimizes the machine in place: unreachable states are pruned, outputs are pushed as close to the initial state 
+        as possible (onward form), and states that behave identically are merged. Rewrites are unaffected
+        
+        Returns:
+            dict: number of states and edges before and after, and how many states were unreachable or merged
+        """
+        self.materialize()
+        if not self.delta:
+            raise ValueError("machines without delta (compiled copies or loaded machines) can't be minimized")
+        
+        # rule attributions survive on the transitions that minimization keeps
+        rule_edges = None
+        if self.table is not None and self.table.rule_edges is not None:
+            rule_edges = {(tr.State(self.table.states[q]), self.table.symbols[sym]):rule for (q, sym), rule in self.table.rule_edges.items()}
+        
+        self.delta, self.finals, report = minimization.minimize(self.delta, self.finals, self.q0)
+        if rule_edges is not None:
+            rule_edges = {(q, sym):rule for (q, sym), rule in rule_edges.items() if q in self.delta and sym in self.delta[q]}
+        self.Q = list(self.delta)
+        self.sigma = set(sym for trans in self.delta.values() for sym in trans)
+        self.gamma = set(out for trans in self.delta.values() for out, _ in trans.values())
+        self.table = tables.compile_table(self.delta, self.finals, self.q0, rule_edges)
+        self.counters = None
+        self.spec = None # merged states no longer correspond to the rules' contexts, so rules can't be added or removed
+        return report
+    
+    
+    def add_rule(self, pair:tuple, context:str=None) -> dict:
+        """Adds a rewrite rule in place. Only the states whose transitions depend on the new rule's context branch are rebuilt
+        
+        Args:
+            pair (tuple): (INPUT, OUTPUT) pair, as given to the function that built the machine (assimilation, deletion or insertion)
+            context (str): context of the new rule, which must be of the machine's context type. None for context free machines
+            
+        Returns:
+            dict: number of states, and how many of them were rebuilt
+        """
+        rule = self._rule(pair, context)
+        if self.rule_type == "insertion" and any(rule[:2] != (_in, _out) for _in, _out, _ in self.spec):
+            raise ValueError("Insertion rules can only take one mapping at a time")
+        
+        _in, _out, con = rule
+        self.rules = self.rules + [f"{_in} -> {_out} / {'_' if con is None else con}"]
+        return self._respec(self.spec + [rule], {i:i for i in range(len(self.spec))})
+    
+    
+    def remove_rule(self, pair:tuple, context:str=None) -> dict:
+        """Removes a rewrite rule in place (the first one, if the machine has it more than once). 
+        Only the states whose transitions depended on the rule's context branch are rebuilt
+        
+        Args:
+            pair (tuple): (INPUT, OUTPUT) pair, as given to the function that built the machine (assimilation, deletion or insertion)
+            context (str): context of the rule. None for context free machines
+            
+        Returns:
+            dict: number of states, and how many of them were rebuilt
+        """
+        normalize = lambda rule: (*rule[:2], rule[2] and " ".join(rule[2].split()))
+        rules = [normalize(rule) for rule in self.spec]
+        rule = self._rule(pair, context)
+        if rule not in rules:
+            raise RuleError(f"the machine has no {pair} rule in context {context}")
+        if len(self.spec) == 1:
+            raise RuleError("a machine needs at least one rule")
+        
+        removed = rules.index(rule)
+        self.rules = self.rules[:removed] + self.rules[removed+1:]
+        rule_map = {i:i if i < removed else i-1 for i in range(len(self.spec)) if i != removed}
+        return self._respec(self.spec[:removed] + self.spec[removed+1:], rule_map)
+    
+    
+    def _rule(self, pair:tuple, context:str=None) -> tuple:
+        """Checks a rule against the machine and returns it as an (insym, outsym, context) rule"""
+        
+        if self.spec is None:
+            raise ValueError("only machines built from rules can have rules added or removed (not minimized, composed or loaded ones)")
+        
+        insym, outsym = rule_mapping(pair, self.rule_type)
+        contexts = [con for _, _, con in self.spec if con is not None]
+        if context is None:
+            if contexts:
+                raise ContextError("a context is required, since the machine's rules are context dependent")
+            return insym, outsym, None
+        if len(contexts) < len(self.spec):
+            raise ContextError("context free machines can't take context dependent rules")
+        
+        validate_context([context])
+        context = insertion_context(context) if self.rule_type == "insertion" else " ".join(context.split())
+        validate_context(contexts + [context])
+        return insym, outsym, context
+    
+    
+    def _respec(self, spec:List[tuple], rule_map:dict) -> dict:
+        """Rebuilds the machine for a new list of (insym, outsym, context) rules, keeping every row of delta that doesn't change"""
+        
+        if self.lazy:
+            # lazy machines have nothing built yet besides their context transitions
+            self.table = LazyTable(tr.rule_transitions(spec), tr.get_transduction_envs(spec), spec, self.table.max_states)
+            self.spec = spec
+            self.finals = dict(self.table.index["finals"])
+            if self.cache is not None:
+                self.cache.clear()
+            return {"states": len(self.table.states), "rebuilt_states": 0}
+        
+        self._ensure_table()
+        rule_edges = {(tr.State(self.table.states[q]), self.table.symbols[sym]):rule for (q, sym), rule in (self.table.rule_edges or {}).items()}
+        
+        self.delta, rule_edges, self._build, rebuilt = incremental.rebuild(self.delta, rule_edges, self.spec, spec, rule_map, 
+                                                                          getattr(self, "_build", None))
+        context_trans = self._build["context_trans"]
+        self.spec = spec
+        self.finals = tr.get_final_mappings(context_trans)
+        self.Q = list(self.delta)
+        self.sigma = set(sym for trans in self.delta.values() for sym in trans)
+        self.gamma = set(t.outsym for t in context_trans) | set(out for trans in self.delta.values() for out, _ in trans.values())
+        self.table = tables.compile_table(self.delta, self.finals, self.q0, rule_edges)
+        
+        # rewrites and rule indices may have changed
+        if self.cache is not None:
+            self.cache.clear()
+        if self.counters is not None:
+            self.instrument()
+        return {"states": len(self.delta), "rebuilt_states": len(rebuilt)}
+    
+    
+    def save(self, path:str):
+        """Saves the compiled machine to a binary file that DFST.load can memory-map
+        
+        Args:
+            path (str): file to write
+        """
+        self.materialize()
+        self._ensure_table()
+        storage.save_table(self.table, path, {"rule_type": self.rule_type, "v0": self.v0, "rules": self.rules, "composed": self.composed})
     
     
     @classmethod
-    def from_rules(cls, insyms, outsyms, contexts=[], v0="", rule_type=""):
+    def load(cls, path:str, mmap=True) -> "DFST":
+        """Loads a machine saved with DFST.save. Like DFST.compiled, the loaded machine only holds its transition table,
+        so it can rewrite and be graphed but cannot be displayed
+        
+        Args:
+            path (str): file to read
+            mmap (bool): memory-map the transition arrays instead of reading them into memory
+            
+        Returns:
+            DFST object: the saved machine
+        """
+        table, metadata = storage.load_table(path, mmap=mmap)
+        return cls({}, table.states, set(table.symbols), set(table.outputs), {}, metadata["rules"], metadata["rule_type"],
+                   v0=metadata["v0"], table=table, composed=metadata.get("composed", False))
+    
+    
+    def _ensure_table(self) -> tables.TransitionTable:
+        """Compiles delta into the transition table, unless it already is"""
+        if self.table is None:
+            self.table = tables.compile_table(self.delta, self.finals, self.q0)
+        return self.table
+    
+    
+    def _tokenize(self, s:str) -> List[str]:
+        """Splits a user's string into input symbols and wraps it in word boundaries"""
+        if self.rule_type == "insertion":
+            return list("$"+ "Ø" + intersperse(s.split(), "Ø") + "Ø" + "$")
+        syms = ("$ " + s + " $").split()
+        if self.composed:
+            composition.check_symbols(self.table, syms)
+        return syms
+    
+    
+    def _finish(self, output:str) -> str:
+        """Strips reserved symbols from a raw output tape, prepends v0 and delimits the symbols"""
+        return intersperse(self.v0 + output.translate(STRIP_RESERVED).strip())
+    
+    
+    
+    @classmethod
+    def from_rules(cls, insyms, outsyms, contexts=[], v0="", rule_type="", cache_dir=None, lazy=False, max_states=MAX_STATES):
         assert len(insyms) == len(outsyms)
+        
+        # check the on-disk compilation cache first (lazy machines are cheap to build and aren't cached)
+        if cache_dir is not None and not lazy:
+            cache = cache_dir if isinstance(cache_dir, CompileCache) else CompileCache(cache_dir)
+            key = cache.key(insyms, outsyms, contexts, rule_type)
+            machine = cache.get(key)
+            if isinstance(machine, cls):
+                machine.v0 = v0
+                return machine
 
-        # this condition block acquires the string representations of rewrite rules for displaying, 
-        # and transduction environments to be used when generating prefix transitions
-        rules = []  
-        transduction_envs = {}
-        if contexts: # context dependent 
-            for con in contexts:
-                for _in, _out in zip(insyms, outsyms):
-                    rules.append(f"{_in} -> {_out} / {con}") 
-                    
-                    _con = con.replace("_", _in).strip()
-                    transduction_envs[_con] = _out
-                    
-        else: # context free 
-            for _in, _out in zip(insyms, outsyms):
-                rules.append(f"{_in} -> {_out} / _")
-
-        transitions = tr.get_transitions(insyms, outsyms, contexts, transduction_envs)
+        # string representations of rewrite rules for displaying
+        spec = tr.rule_spec(insyms, outsyms, contexts)
+        rules = [f"{_in} -> {_out} / {'_' if con is None else con}" for _in, _out, con in spec]
+        machine = cls.from_spec(spec, rules, v0=v0, rule_type=rule_type, lazy=lazy, max_states=max_states)
+        
+        if cache_dir is not None and not lazy:
+            cache.put(key, machine)
+        return machine
+    
+    
+    @classmethod
+    def from_spec(cls, spec, rules, v0="", rule_type="", lazy=False, max_states=MAX_STATES):
+        """Builds a machine from (insym, outsym, context) rules, as expanded by transitions.rule_spec"""
+        
+        # transduction environments are used when generating prefix transitions
+        transduction_envs = tr.get_transduction_envs(spec)
+        
+        timings = {}
+        if lazy:
+            # only the context transitions are built now. Prefix transitions are generated per state by the LazyTable
+            start = time.perf_counter()
+            context_trans = tr.rule_transitions(spec)
+            timings["context_transitions"] = time.perf_counter() - start
+            
+            start = time.perf_counter()
+            table = LazyTable(context_trans, transduction_envs, spec, max_states)
+            Q, sigma, gamma = tr.get_Q_sigma_gamma(context_trans)
+            timings["lazy_table"] = time.perf_counter() - start
+            return cls({}, Q, sigma, gamma, dict(table.index["finals"]), rules, v0=v0, rule_type=rule_type, table=table, 
+                       compile_times=timings, spec=spec)
+        
+        transitions = tr.get_transitions(spec=spec, transduction_envs=transduction_envs, timings=timings)
+        
+        start = time.perf_counter()
         delta = tr.get_delta(transitions)
+        rule_edges = tr.get_rule_edges(transitions, delta)
+        timings["delta"] = time.perf_counter() - start
+        
+        start = time.perf_counter()
         Q, sigma, gamma = tr.get_Q_sigma_gamma(transitions)
         finals = tr.get_final_mappings(transitions)
+        del transitions # the transitions are the bulk of the peak compile memory, and the table doesn't need them
+        timings["Q_sigma_gamma_finals"] = time.perf_counter() - start
+        
+        start = time.perf_counter()
+        table = tables.compile_table(delta, finals, tr.LAMBDA, rule_edges)
+        timings["table"] = time.perf_counter() - start
+        
+        return cls(delta, Q, sigma, gamma, finals, rules, v0=v0, rule_type=rule_type, table=table, compile_times=timings, spec=spec)
+
+    
+
+def compose(*machines:DFST) -> DFST:
+    """Composes a cascade of machines into a single machine, such that compose(A, B, C).rewrite(s) == C.rewrite(B.rewrite(A.rewrite(s)))
+    for every s whose symbols are separated by spaces. The composed machine reads a symbol it doesn't know as a whole, while the
+    cascade would split it into characters, so the composed machine raises a ValueError on unknown symbols of several characters
+    (e.g. "fo" in "hello fo") instead of rewriting them differently
+    
+    Args:
+        machines (DFST): machines in the order they would be applied
+        
+    Returns:
+        DFST object: DFST that applies the whole cascade in one pass
+    """
+    if not machines:
+        raise ValueError("compose needs at least one machine")
+    return reduce(_compose_pair, machines)
+
+
+
+def _compose_pair(first:DFST, second:DFST) -> DFST:
+    
+    for machine in (first, second):
+        machine.materialize()
+        machine._ensure_table()
             
-        return cls(delta, Q, sigma, gamma, finals, rules, v0=v0, rule_type=rule_type)
+    delta, finals, start_out = composition.compose_tables(first.table, second.table, first.v0, second.rule_type == "insertion")
+    
+    # the composed machine reads its input like the first machine, and whatever the second machine outputs 
+    # before the first symbol is read becomes part of v0
+    v0 = second.v0 + start_out.translate(STRIP_RESERVED).strip()
+    Q = list(delta)
+    sigma = set(sym for trans in delta.values() for sym in trans)
+    gamma = set(out for trans in delta.values() for out, _ in trans.values())
+    table = tables.compile_table(delta, finals, tr.State("λ"))
+    
+    return DFST(delta, Q, sigma, gamma, finals, first.rules + second.rules, first.rule_type, v0=v0, table=table, composed=True)
+    
+
+
+# machine used by rewrite_parallel workers, set once per process by _init_worker
+_worker_machine = None
 
+def _init_worker(machine):
+    global _worker_machine
+    _worker_machine = machine
     
     
-def assimilation(pairs:List[tuple], contexts=[], v0="") -> DFST:
+def _rewrite_chunk(chunk):
+    return _worker_machine.rewrite_many(chunk)
+    
+    
+    
+def rule_mapping(pair:tuple, rule_type:str) -> tuple:
+    """Checks an (INPUT, OUTPUT) pair against a rule type and returns the (insym, outsym) the machine transduces with"""
+    
+    insym, outsym = pair
+    if rule_type == "assimilation" and insym and outsym:
+        return insym, outsym
+    if rule_type == "deletion" and insym and not outsym:
+        return insym, "Ø"
+    if rule_type == "insertion" and not insym and outsym:
+        return "Ø", outsym
+    raise RuleError(f"Invalid pair {insym, outsym}")
+
+
+
+def insertion_context(context:str) -> str:
+    """Rewrites an insertion context so that it reads the Ø symbols insertion machines see between symbols"""
+    
+    apply_intersperse = lambda string : intersperse(string.split(), "Ø")
+    underscore = context.index("_")
+    
+    if underscore == len(context)-1: # left context
+        context = context[:underscore]
+        new_context = list("Ø" + apply_intersperse(context))
+        return validate_insertion_context(" ".join(new_context) + " _")
+
+    elif underscore == 0: # right context
+        context = context[underscore+1:]
+        new_context = list(apply_intersperse(context))
+        return validate_insertion_context("_ " + " ".join(new_context))
+
+    else: # dual context
+        left, right = context.split("_")
+        left = list( "Ø" + apply_intersperse(left))
+        right = list(apply_intersperse(right) + "Ø")
+        
+        dual = " ".join(left) + " _ " + " ".join(right)
+        return validate_insertion_context(dual)
+
+
+
+def assimilation(pairs:List[tuple], contexts=[], v0="", cache_dir=None, lazy=False, max_states=MAX_STATES) -> DFST:
     """Handles assimilation rewrite rules such that existing symbols are mapped to new ones
     
     Args:
         pairs (List[tuple]): list of (INPUT, OUTPUT) pairs. 
         contexts (list): list of contexts for mapping to transpire
         v0(str): optional string to prepend to output tape (is not involved in transduction)
+        cache_dir (str | CompileCache): optional directory of previously compiled machines to check before compiling
+        lazy (bool): only expand states when a rewrite first reaches them (see DFST.from_rules)
+        max_states (int): maximum number of expanded states a lazy machine keeps in memory
         
     Returns:
         DFST object: DFST instantiated through rewrite rules
@@ -194,24 +675,26 @@ def assimilation(pairs:List[tuple], contexts=[], v0="") -> DFST:
         validate_context(contexts)
     
     insyms, outsyms = [], []
-    for insym, outsym in pairs:
-        if not insym or not outsym:
-            raise RuleError(f"Invalid pair {insym, outsym}")
-
+    for pair in pairs:
+        insym, outsym = rule_mapping(pair, "assimilation")
         insyms.append(insym)
         outsyms.append(outsym)
         
-    return DFST.from_rules(insyms, outsyms, contexts, v0=v0, rule_type="assimilation")
+    return DFST.from_rules(insyms, outsyms, contexts, v0=v0, rule_type="assimilation", cache_dir=cache_dir,
+                           lazy=lazy, max_states=max_states)
     
     
     
-def deletion(pairs:List[tuple], contexts=[], v0="") -> DFST:
+def deletion(pairs:List[tuple], contexts=[], v0="", cache_dir=None, lazy=False, max_states=MAX_STATES) -> DFST:
     """Handles deletion rewrite rules such that existing symbols are mapped to the empty string.
     
     Args:
         pairs (List[tuple]): list of (INPUT, "") pairs 
         contexts (list): list of contexts for mapping to transpire
         v0(str): optional string to prepend to output tape (is not involved in transduction)
+        cache_dir (str | CompileCache): optional directory of previously compiled machines to check before compiling
+        lazy (bool): only expand states when a rewrite first reaches them (see DFST.from_rules)
+        max_states (int): maximum number of expanded states a lazy machine keeps in memory
         
     Returns:
         DFST object: DFST instantiated through rewrite rules
@@ -221,24 +704,26 @@ def deletion(pairs:List[tuple], contexts=[], v0="") -> DFST:
         validate_context(contexts)
     
     insyms, outsyms = [], []
-    for insym, outsym in pairs:
-        if not insym or outsym:
-            raise RuleError(f"Invalid pair {insym, outsym}")
-
+    for pair in pairs:
+        insym, outsym = rule_mapping(pair, "deletion")
         insyms.append(insym)
-        outsyms.append("Ø")
+        outsyms.append(outsym)
         
-    return DFST.from_rules(insyms, outsyms, contexts, v0=v0, rule_type="deletion")
+    return DFST.from_rules(insyms, outsyms, contexts, v0=v0, rule_type="deletion", cache_dir=cache_dir,
+                           lazy=lazy, max_states=max_states)
     
     
     
-def insertion(pairs:List[tuple], contexts=[], v0="") -> DFST:
+def insertion(pairs:List[tuple], contexts=[], v0="", cache_dir=None, lazy=False, max_states=MAX_STATES) -> DFST:
     """Handles insertion rewrite rules such that the empty string is mapped to a new symbol.
     
     Args:
         pair (List[tuple]): list containing a ("", OUTPUT) pair (Note: insertion can only handle one mapping at a time)
         contexts (list): list of contexts for mapping to transpire
         v0(str): optional string to prepend to output tape (is not involved in transduction)
+        cache_dir (str | CompileCache): optional directory of previously compiled machines to check before compiling
+        lazy (bool): only expand states when a rewrite first reaches them (see DFST.from_rules)
+        max_states (int): maximum number of expanded states a lazy machine keeps in memory
         
     Returns:
         DFST object: DFST instantiated through rewrite rules
@@ -251,41 +736,123 @@ def insertion(pairs:List[tuple], contexts=[], v0="") -> DFST:
         raise ValueError("Insertion rules can only take one mapping at a time")
         
     insyms, outsyms = [], []
-    for insym, outsym in pairs:
-        if insym or not outsym:
-            raise RuleError(f"Invalid pair {insym, outsym}")
-
-        insyms.append("Ø")
+    for pair in pairs:
+        insym, outsym = rule_mapping(pair, "insertion")
+        insyms.append(insym)
         outsyms.append(outsym)
         
-    contexts_insertion = []
-    apply_intersperse = lambda string : intersperse(string.split(), "Ø")
-    for context in contexts:
-        underscore = context.index("_")
-        
-        if underscore == len(context)-1: # left context
-            context = context[:underscore]
-            new_context = list("Ø" + apply_intersperse(context))
-            new_context = validate_insertion_context(" ".join(new_context) + " _")
-            contexts_insertion.append(new_context)
-
-        elif underscore == 0: # right context
-            context = context[underscore+1:]
-            new_context = list(apply_intersperse(context))
-            new_context = validate_insertion_context("_ " + " ".join(new_context))
-            contexts_insertion.append(new_context)
-
-        else: # dual context
-            left, right = context.split("_")
-            left = list( "Ø" + apply_intersperse(left))
-            right = list(apply_intersperse(right) + "Ø")
-            
-            dual = " ".join(left) + " _ " + " ".join(right)
-            dual = validate_insertion_context(dual)
-            contexts_insertion.append(dual)
+    contexts_insertion = [insertion_context(context) for context in contexts]
             
-    return DFST.from_rules(insyms, outsyms, contexts_insertion, v0=v0, rule_type="insertion")
+    return DFST.from_rules(insyms, outsyms, contexts_insertion, v0=v0, rule_type="insertion", cache_dir=cache_dir,
+                           lazy=lazy, max_states=max_states)
+
+
+
+
+# factory function of each rule type, as named in rule set definitions
+FACTORIES = {"assimilation": assimilation, "deletion": deletion, "insertion": insertion}
+
 
+def from_definition(definition:dict, cache_dir=None) -> DFST:
+    """Compiles a rule set definition: {"type": "assimilation", "pairs": [["t", "ɾ"]], "contexts": ["a _ a"], "v0": ""}.
+    type defaults to assimilation, and contexts and v0 are optional
+    
+    Raises:
+        RuleError: if the definition isn't a dict, has an unknown rule type or no pairs, or a pair isn't an [input, output] pair
+            or a context isn't a string
+    """
+    if not isinstance(definition, dict):
+        raise RuleError(f"a rule set definition must be an object, not {type(definition).__name__} {definition!r}")
+    
+    rule_type = definition.get("type", "assimilation")
+    if rule_type not in FACTORIES:
+        raise RuleError(f"unknown rule type {rule_type!r}, expected one of {', '.join(FACTORIES)}")
+    if not definition.get("pairs"):
+        raise RuleError("a rule set definition needs at least one pair")
+    
+    for i, pair in enumerate(definition["pairs"]):
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+            raise RuleError(f"pair {i} must be an [input, output] pair, not {pair!r}")
+    for i, context in enumerate(definition.get("contexts", [])):
+        if not isinstance(context, str):
+            raise RuleError(f"context {i} must be a string, not {context!r}")
+    
+    pairs = [tuple(pair) for pair in definition["pairs"]]
+    return FACTORIES[rule_type](pairs, definition.get("contexts", []), v0=definition.get("v0", ""), cache_dir=cache_dir)
+
+
+
+@dataclass
+class CompileResult:
+    
+    index:int # position of the rule set in the input of compile_many
+    machine:DFST = None # None if compilation failed
+    seconds:float = 0.0 # wall time spent compiling (or failing to)
+    compile_times:dict = None # seconds spent in each phase of from_rules
+    error:Exception = None
+    
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+
+def _compile_definition(job) -> CompileResult:
+    index, definition, cache_dir = job
+    start = time.perf_counter()
+    try:
+        machine = from_definition(definition, cache_dir)
+    except (RuleError, ContextError) as e:
+        return CompileResult(index, seconds=time.perf_counter() - start, error=type(e)(f"rule set {index}: {e}"))
+    except Exception as e:
+        return CompileResult(index, seconds=time.perf_counter() - start, error=e)
+    return CompileResult(index, machine, time.perf_counter() - start, machine.compile_times)
+
+
+
+def _compile_cost(definition:dict) -> int:
+    """Rough relative compile cost of a rule set: the number of context symbols times the number of pairs"""
+    try:
+        contexts = definition.get("contexts") or ["_"]
+        return len(definition.get("pairs") or ()) * sum(len(context.split()) for context in contexts)
+    except (AttributeError, TypeError):
+        return 0 # malformed, from_definition rejects it
+
+
+
+def compile_many(definitions:List[dict], workers=None, cache_dir=None, raise_errors=False) -> List[CompileResult]:
+    """Compiles many independent rule sets across a pool of worker processes
+    
+    Args:
+        definitions (List[dict]): rule set definitions (see from_definition)
+        workers (int): number of worker processes. Defaults to the number of CPUs. With 1, everything is compiled in this process
+        cache_dir (str | CompileCache): optional compilation cache shared by the workers (see DFST.from_rules)
+        raise_errors (bool): raise the error of the first rule set (in input order) that failed to compile, once all are done
+        
+    Returns:
+        List[CompileResult]: one result per rule set, in the same order as definitions
+    """
+    if workers is not None and workers < 1:
+        raise ValueError("workers must be at least 1")
+    
+    jobs = [(i, definition, cache_dir) for i, definition in enumerate(definitions)]
+    
+    if workers == 1 or len(jobs) <= 1:
+        results = [_compile_definition(job) for job in jobs]
+    else:
+        # the most expensive rule sets are started first, so that a big one doesn't start last and hold up the whole build
+        results = [None] * len(jobs)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_compile_definition, job) for job in sorted(jobs, key=lambda job: -_compile_cost(job[1]))]
+            for future in futures:
+                result = future.result()
+                results[result.index] = result
+    
+    if raise_errors:
+        for result in results:
+            if not result.ok:
+                raise result.error
+    return results
 
 
 
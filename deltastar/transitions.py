@@ -3,16 +3,39 @@
 # this file contains functions for parsing the user's specified rewrite rule(s) and 
 # generating the appropriate transitions based off of contexts
 
+import time
+import weakref
 from collections import defaultdict
-from dataclasses import dataclass
 from utils.funcs import PH, string_complement, despace
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ Constructors~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-@dataclass(frozen=True) # frozen makes the class immutable so States can be dict keys in delta
 class State:
+    """An immutable, interned state: while a state with some label exists, State(label) returns that same object,
+    so delta, Q and the compilation indexes all share one instance (and one hash) per label"""
     
-    label:str
+    __slots__ = ("label", "__weakref__")
+    
+    def __new__(cls, label:str):
+        state = _states.get(label)
+        if state is None:
+            state = object.__new__(cls)
+            object.__setattr__(state, "label", label)
+            _states[label] = state
+        return state
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("states are immutable") # so States can be dict keys in delta
+    
+    def __reduce__(self):
+        # unpickled (and copied) states are interned again
+        return State, (self.label,)
+    
+    def __eq__(self, other):
+        return self is other or isinstance(other, State) and self.label == other.label
+    
+    def __hash__(self):
+        return hash(self.label)
 
     def __len__(self):
         return len(self.label)
@@ -21,29 +44,93 @@ class State:
         return self.label
     
     def __getitem__(self, idx):
-        string = self.label
-        if isinstance(idx, slice): # idx is a slice object in this case
-            start,stop,step = idx.indices(len(string))
-            return "".join([string[i] for i in range(start,stop,step)])
-        else:
-            return string[idx]
+        return self.label[idx]
+    
+    def __iter__(self):
+        return iter(self.label)
+
+
+# label -> State. States are dropped once nothing refers to them anymore
+_states = weakref.WeakValueDictionary()
+
+LAMBDA = State("λ") # initial state
 
 
 
-@dataclass
 class Edge:
     
-    start:State
-    insym:str
-    outsym:str
-    end:State
-    ctype:str = None # context type (left, right, or dual)
-    is_transduction:bool = False 
-    seen_Lcon:str = ""
+    __slots__ = ("start", "insym", "outsym", "end", "ctype", "is_transduction", "seen_Lcon", "rule")
+    
+    def __init__(self, start:State, insym:str, outsym:str, end:State, ctype:str=None, is_transduction=False, seen_Lcon="", rule:int=None):
+        self.start = start
+        self.insym = insym
+        self.outsym = outsym
+        self.end = end
+        self.ctype = ctype # context type (left, right, or dual)
+        self.is_transduction = is_transduction
+        self.seen_Lcon = seen_Lcon
+        self.rule = rule # for transductions, index of the rewrite rule (in DFST.rules) they apply
+    
+    def __eq__(self, other):
+        if not isinstance(other, Edge):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in Edge.__slots__)
+    
+    __hash__ = None # edges are mutable
     
     def __repr__(self):
         return f"({self.start} | {self.insym} -> {self.outsym} | {self.end})"   
 
+
+
+class Edges:
+    """Struct-of-arrays list of transitions: one list per Edge field instead of one object per transition.
+    Prefix transitions, which make up most of a machine, are generated straight into it during compilation"""
+    
+    __slots__ = Edge.__slots__
+    
+    def __init__(self, edges=()):
+        for name in Edges.__slots__:
+            setattr(self, name, [])
+        self.extend(edges)
+        
+    def append(self, start:State, insym:str, outsym:str, end:State, ctype:str=None, is_transduction=False, seen_Lcon="", rule:int=None):
+        self.start.append(start)
+        self.insym.append(insym)
+        self.outsym.append(outsym)
+        self.end.append(end)
+        self.ctype.append(ctype)
+        self.is_transduction.append(is_transduction)
+        self.seen_Lcon.append(seen_Lcon)
+        self.rule.append(rule)
+    
+    def extend(self, edges):
+        if isinstance(edges, Edges):
+            for name in Edges.__slots__:
+                getattr(self, name).extend(getattr(edges, name))
+        else:
+            for t in edges:
+                self.append(t.start, t.insym, t.outsym, t.end, t.ctype, t.is_transduction, t.seen_Lcon, t.rule)
+    
+    def __len__(self):
+        return len(self.start)
+    
+    def __getitem__(self, i) -> Edge:
+        return Edge(*(getattr(self, name)[i] for name in Edges.__slots__))
+    
+    def __iter__(self):
+        # Edge objects are only created on demand, one at a time
+        return map(Edge, self.start, self.insym, self.outsym, self.end, self.ctype, self.is_transduction, self.seen_Lcon, self.rule)
+    
+    def __repr__(self):
+        return f"Edges({len(self)})"
+
+
+
+def columns(trans) -> Edges:
+    """trans as an Edges (lists of Edge objects are converted)"""
+    return trans if isinstance(trans, Edges) else Edges(trans)
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ 
 def parse_contexts(contexts):
    
@@ -63,48 +150,73 @@ def parse_contexts(contexts):
 
 
 
-def cf_transitions(insyms, outsyms,q0="λ"):
+class EdgeSet:
+    """Insertion ordered set of the context transitions generated so far. Contexts that share a prefix generate the same
+    edges out of the states labeled by that prefix, so every edge is kept once, however many contexts and mappings add it"""
+    
+    def __init__(self):
+        self.edges = []
+        self._seen = set()
+        
+    def add(self, edge:Edge):
+        key = (edge.start, edge.insym, edge.outsym, edge.end, edge.ctype, edge.is_transduction, edge.seen_Lcon)
+        if key not in self._seen:
+            self._seen.add(key)
+            self.edges.append(edge)
+
+
+
+def rule_index(rules, rule_offset, i):
+    """Index (in DFST.rules) of the i-th (context, mapping) pair of a call: rules[i] if the rule indices were given, else rule_offset + i"""
+    return rules[i] if rules is not None else rule_offset + i
+
+
+
+def cf_transitions(insyms, outsyms,q0="λ", rule_offset=0, edge_set=None, rules=None):
     
     # all CF transitions are self loops on initial state
-    t = []
-    for _in, _out in zip (insyms, outsyms): 
-        t.append(Edge(State(q0),_in, _out, State(q0), ctype="cf"))
+    edge_set = EdgeSet() if edge_set is None else edge_set
+    for i, (_in, _out) in enumerate(zip(insyms, outsyms)): 
+        edge_set.add(Edge(State(q0),_in, _out, State(q0), ctype="cf", rule=rule_index(rules, rule_offset, i)))
         
-    t.append(Edge(State(q0),PH, PH, State(q0), ctype="cf"))
-    return t
+    edge_set.add(Edge(State(q0),PH, PH, State(q0), ctype="cf"))
+    return edge_set.edges
     
     
     
-def Lcon_transitions(insyms, outsyms, contexts, q0="λ", dual=False):
+def Lcon_transitions(insyms, outsyms, contexts, q0="λ", dual=False, rule_offset=0, edge_set=None, rules=None):
     
-    t = []
-    for context in contexts:
+    edge_set = EdgeSet() if edge_set is None else edge_set
+    for c, context in enumerate(contexts):
         
         # fixes an annoying bug w.r.t left vs. dual context transition generation
         con = context[:-1] if not dual else context
-        for _in, _out in zip(insyms, outsyms):
-            start = q0
-            end = ""     
-            ctype = "left"        
-            
-            for sym in con:                        
-                end += sym # build the next state symbol by symbol 
-                t.append(Edge(State(start), sym, sym, State(end), ctype=ctype))
-                t.append(Edge(State(start), PH, PH, State(q0), ctype=ctype))
-                 
-                start = end # update start state
-            
-            t.append(Edge(State(start), _in, _out, State(q0), ctype=ctype, is_transduction=True)) 
-            t.append(Edge(State(start), PH, PH, State(q0),  ctype=ctype))   
-    return t
+        start = q0
+        end = ""     
+        ctype = "left"        
+        
+        # the context is walked once, whatever the number of mappings
+        for sym in con:                        
+            end += sym # build the next state symbol by symbol 
+            edge_set.add(Edge(State(start), sym, sym, State(end), ctype=ctype))
+            edge_set.add(Edge(State(start), PH, PH, State(q0), ctype=ctype))
+             
+            start = end # update start state
+        
+        # mappings are only attached at the end of the context (dual contexts attach them at the end of the right context instead)
+        if not dual:
+            for m, (_in, _out) in enumerate(zip(insyms, outsyms)):
+                edge_set.add(Edge(State(start), _in, _out, State(q0), ctype=ctype, is_transduction=True, rule=rule_index(rules, rule_offset, c*len(insyms) + m))) 
+        edge_set.add(Edge(State(start), PH, PH, State(q0),  ctype=ctype))   
+    return edge_set.edges
 
 
 
-def Rcon_transitions(insyms, outsyms, contexts, q0="λ", Lcon=[],dual=False):
+def Rcon_transitions(insyms, outsyms, contexts, q0="λ", Lcon=[],dual=False, rule_offset=0, edge_set=None, rules=None):
    
-    t = []
-    for context in contexts:
-        for _in, _out in zip(insyms, outsyms):
+    edge_set = EdgeSet() if edge_set is None else edge_set
+    for c, context in enumerate(contexts):
+        for m, (_in, _out) in enumerate(zip(insyms, outsyms)):
             
             # transition generation depend on if its strictly right or dual context 
             if dual:
@@ -127,17 +239,17 @@ def Rcon_transitions(insyms, outsyms, contexts, q0="λ", Lcon=[],dual=False):
                 seen_Lcon = leftcon if dual else None
                 
                  # all transitions moving to the right will output the empty string ("λ")
-                t.append(Edge(State(start), sym, "λ", State(end), ctype=ctype, seen_Lcon=seen_Lcon))
+                edge_set.add(Edge(State(start), sym, "λ", State(end), ctype=ctype, seen_Lcon=seen_Lcon))
                  
                 output = start 
                 if start == q0: # initial state gets a PH:PH transition
-                    t.append(Edge(State(start), PH,PH, State(q0), ctype=ctype)) 
+                    edge_set.add(Edge(State(start), PH,PH, State(q0), ctype=ctype)) 
                       
                 # if unknown symbol, need to output the state name along with PH symbol
                 # for dual contexts, subtract the left context that has already been output
                 output = string_complement(start, leftcon, pad="left") if dual else start if start != "λ" else ""
                     
-                t.append(Edge(State(start), PH, (output + PH), State(q0), ctype=ctype)) 
+                edge_set.add(Edge(State(start), PH, (output + PH), State(q0), ctype=ctype)) 
                 start = end
                 
             # reached the end of the context
@@ -149,198 +261,355 @@ def Rcon_transitions(insyms, outsyms, contexts, q0="λ", Lcon=[],dual=False):
             # transduction: output out symbol + state name   
             mapping = _out + "".join(con) 
         
-            t.append(Edge(State(start), right_context[-1], mapping, State(q0), ctype=ctype, is_transduction=True, seen_Lcon=seen_Lcon)) 
-            t.append(Edge(State(start), PH, (output + PH), State(q0), ctype=ctype))      
+            edge_set.add(Edge(State(start), right_context[-1], mapping, State(q0), ctype=ctype, is_transduction=True, seen_Lcon=seen_Lcon, rule=rule_index(rules, rule_offset, c*len(insyms) + m))) 
+            edge_set.add(Edge(State(start), PH, (output + PH), State(q0), ctype=ctype))      
                 
-    return t
+    return edge_set.edges
 
 
 
-def Dcon_transitions(insyms, outsyms, contexts,q0="λ"):
+def Dcon_transitions(insyms, outsyms, contexts,q0="λ", rule_offset=0, edge_set=None, rules=None):
 
-    t = []
- 
-    for context in contexts:
+    # one edge set is shared by every context, so left contexts (and right contexts after them) are only added once
+    edge_set = EdgeSet() if edge_set is None else edge_set
+    for c, context in enumerate(contexts):
         underscore = context.index("_")
         left_context = [context[:underscore]]
         right_context = [context[underscore+1:]]
         
-        left_trans = [con for con in Lcon_transitions(insyms, outsyms, left_context, q0, dual=True) if not con.is_transduction] # filter out transduction transitions
-        right_trans = Rcon_transitions(insyms, outsyms, right_context, Lcon=left_context, dual=True)
-        dual_trans = left_trans + right_trans
-       
-        t.extend(dual_trans)  
-    return t
+        Lcon_transitions(insyms, outsyms, left_context, q0, dual=True, edge_set=edge_set)
+        Rcon_transitions(insyms, outsyms, right_context, Lcon=left_context, dual=True, rule_offset=rule_offset + c*len(insyms), edge_set=edge_set,
+                         rules=rules[c*len(insyms):(c+1)*len(insyms)] if rules is not None else None)
+    return edge_set.edges
+
+
+
+def index_by_start(trans, keep_PH=False):
+    """Maps each start state to its non-PH transitions (or all of its transitions if keep_PH), in their original order"""
+    
+    index = defaultdict(list)
+    for t in trans:
+        if keep_PH or t.insym != PH:
+            index[t.start].append(t)
+    return index
+
+
+
+def prefix_index(context_trans, transduction_envs):
+    """Precomputes everything prefix transitions are derived from, so that they can be generated one state at a time"""
+    
+    Q, _, _ = get_Q_sigma_gamma(context_trans)
+    Q.remove(LAMBDA) # remove λ state 
+    
+    # hash indexes over context_trans so that each candidate prefix transition is resolved without rescanning it
+    trans_by_start = index_by_start(context_trans)
+    Q_labels = set(q.label for q in Q)
+    
+    # ordered so that the generated transitions (and which duplicate get_delta keeps) don't depend on hashing
+    sigma = list(dict.fromkeys(t.insym for t in context_trans if t.insym != PH)) # PH symbol doesnt have prefix transitions
+    
+    return {
+        "Q": Q,
+        "Q_labels": Q_labels,
+        "sigma": sigma,
+        "children": trie_children(Q_labels, sigma),
+        "links": {},
+        "finals": get_final_mappings(context_trans),
+        "envs": index_envs(transduction_envs),
+        "trans_by_start": trans_by_start,
+        "seen_by_start": {start:set(t.insym for t in trans if not t.is_transduction) for start, trans in trans_by_start.items()},
+    }
+
+
+
+def index_envs(transduction_envs):
+    """Maps each (despaced) transduction environment to the (position, output mapping) pairs it was given in"""
+    
+    envs = defaultdict(list)
+    for i, (env, out_mapping) in enumerate(transduction_envs.items()):
+        envs[despace(env)].append((i, out_mapping))
+    return dict(envs)
+
+
+
+def trie_children(Q_labels, sigma):
+    """Maps every label that a state label extends by one symbol of sigma to those state labels, in sigma order"""
+    
+    order = {sym:i for i, sym in enumerate(sigma)}
+    children = defaultdict(list)
+    for label in Q_labels:
+        for i in range(len(label)):
+            sym = label[i:]
+            if sym in order:
+                children[label[:i]].append((order[sym], label))
+    return {parent:[label for _, label in sorted(labels)] for parent, labels in children.items()}
+
+
+
+def failure_links(label, index):
+    """Returns the proper suffixes of a label (longest first, the empty string included) that have children in the trie.
+    Like the failure links of an Aho-Corasick automaton, each suffix's own links are reused for the shorter ones"""
+    
+    links = index["links"]
+    if label not in links:
+        children = index["children"]
+        chain = []
+        for i in range(1, len(label)+1):
+            suffix = label[i:]
+            if suffix in children:
+                chain = [suffix] + failure_links(suffix, index)
+                break
+        links[label] = chain
+    return links[label]
+
+
+
+def state_transitions(start, trans_by_start, index):
+    """Every transition leaving a state: its context transitions (trans_by_start is built by index_by_start with keep_PH) 
+    followed by its prefix transitions. get_delta over them gives the state's row of delta"""
+    
+    trans = Edges(trans_by_start.get(start, ()))
+    if start.label != "λ":
+        state_prefix_transitions(start, index, trans)
+    return trans
 
 
 
 def prefix_transitions(context_trans, transduction_envs):
     
-    Q, sigma, _ = get_Q_sigma_gamma(context_trans)
-    Q.remove(State("λ")) # remove λ state 
-    sigma = list(sigma)
-    sigma.remove(PH) # remove PH symbol from sigma since it doesnt have prefix transitions
-    finals = get_final_mappings(context_trans)
-    transitions_to_add = []  
+    index = prefix_index(context_trans, transduction_envs)
+    edges = Edges()
+    for q in index["Q"]:
+        state_prefix_transitions(q, index, edges)
+    return edges
 
-    for q in Q:
-        q = q.label
-        
-        # exclude the first symbol because first symbol marks beginning of a "branch" of states (i.e. all states branching from state <a> begin with an "a")
-        # this also lets us jump from one "branch" to another (i.e. <b> branch, <c> branch, etc..)
-        pfxstate = q[1:]
-        possible_prefix_trans = []
+
+
+def state_prefix_transitions(start, index, edges=None):
+    """Generates the prefix transitions of a single (non λ) state from the index built by prefix_index, 
+    appended to edges (a new Edges if not given) which is returned"""
+    
+    finals, envs, children = index["finals"], index["envs"], index["children"]
+    
+    transitions_to_add = Edges() if edges is None else edges
+    q = start.label
+    matched_trans = index["trans_by_start"].get(start, []) # all already existing transitions that have q as a start state  
+    symbol_seen = index["seen_by_start"].get(start, set())
+    
+    # prefix transitions go from q to the states that extend a proper suffix of q by one symbol (the first symbol is excluded
+    # because it marks the beginning of a "branch" of states, which lets us jump from one "branch" to another).
+    # Only suffixes that are followed by states are visited, so every end state exists
+    possible_prefix_ends = [end for suffix in failure_links(q, index) for end in children[suffix]]
+           
+    for end_label in possible_prefix_ends:
+        end = State(end_label)
+            
+        # get the last seen symbol to be used in the added prefix transition
+        last_seen_symbol = end_label if end_label[-1] == "]" else end_label[-1] # tag handling         
         
-        # generate all possible prefix transitions for each state in Q by combining the prefix with all symbols in sigma
-        for _ in range(len(pfxstate)+1):
-            possible_prefix_trans.extend([Edge(State(q), PH, PH, State(pfxstate + s)) for s in sigma])
-            pfxstate = pfxstate[1:]
-               
-        for ppt in possible_prefix_trans:
+        # if a matched transition already has a (non transduction) transition with the last seen symbol, no prefix transition is needed
+        if last_seen_symbol in symbol_seen:
+            continue
             
-            if ppt.end in Q: # disregard states that dont exist
-                
-                # find all already existing transitions that have ppt.start as a start state  
-                matched_trans = [ct for ct in context_trans if ct.start == ppt.start and ct.insym != PH]
+        # modify the transition output depending on the matched transition's context type and append to transitions_to_add
+        for match in matched_trans:
+            ctype = match.ctype
+            lcon = match.seen_Lcon
+            output = last_seen_symbol
+            is_transduction = False
+        
+            if ctype == "dual":
                 
-                # get the last seen symbol to be used in the added prefix transition
-                last_seen_symbol = str(ppt.end) if ppt.end[-1] == "]" else ppt.end[-1] # tag handling         
+                if q != end_label:
+                    
+                    # check if the state doesn't have an output (i.e., if its left context)
+                    if not finals[end]:
+                        output = string_complement(start, lcon, pad="left") + end_label 
+                    else:
+                        output = string_complement(start, lcon, pad="left") + "λ"
+                    
+            elif ctype == "right":
                 
-                # for each matched transition, find out if it already has a transition with the last seen symbol,
-                symbol_seen = []
-                for mt in matched_trans: 
-                    if mt.insym == last_seen_symbol and not mt.is_transduction:
-                        symbol_seen.append(mt)
-                      
-                # modify the transition output depending on the matched transition's context type and append to transitions_to_add
-                if not symbol_seen:
-                    for match in matched_trans:
-                        ctype = match.ctype
-                        lcon = match.seen_Lcon
-                        output = last_seen_symbol
-                        is_transduction = False
+                # self loops should only get last_seen_symbol. Otherwise, concatenate state name with last_seen_symbol
+                if q != end_label:
+                    
+                    outsym = q + last_seen_symbol
                     
-                        if ctype == "dual":
-                            
-                            if ppt.start.label != ppt.end.label:
-                                
-                                # check if the state doesn't have an output (i.e., if its left context)
-                                if not finals[ppt.end]:
-                                    output = string_complement(ppt.start, lcon, pad="left") +  ppt.end.label 
-                                else:
-                                    output = string_complement(ppt.start, lcon, pad="left") + "λ"
-                                
-                        elif ctype == "right":
-                            
-                            # self loops should only get last_seen_symbol. Otherwise, concatenate state name with last_seen_symbol
-                            if ppt.start.label != ppt.end.label:
-                                
-                                outsym = ppt.start.label + last_seen_symbol
-                                
-                                # important line: when going to a right context state, we dont want to send the entire outsym to the output tape
-                                output = string_complement(outsym, ppt.end.label, pad="right")
-                                
-                                for env, out_mapping in transduction_envs.items():
-                                    env = despace(env)
-                                    
-                                    # checks to see if the prefix trans output also creates an environment for a transduction 
-                                    if outsym.endswith(env) and outsym != env: 
-                                        output = output[:-1] + out_mapping    
-                            output += "λ"
-                                
-                        # this block handles the transduction transition, i.e., whether the transduction should point to a prefix state, or q0      
-                        find_mapping = [t for t in matched_trans if t.is_transduction]
-                        if match in find_mapping and match.insym == last_seen_symbol:
-                            is_transduction = True # setting this lets the already existing PH transduction get overwritten in make_delta()                           
-                            output = match.outsym
-                            
-                            # transduction prefix transitions can get dicey. When ctype == right, need to subtract the end state from the output symbol
-                            if ctype == "right":
-                                output = string_complement(match.outsym, ppt.end.label, pad="right") 
-                              
-                            if ctype == "dual":
-                                if finals[ppt.end]:
-                                    output = output[:-1]
-                                    
-                                    #! possibly volatile conditional
-                                    # edge case: self loop on transduction transition and last symbol of output matches the last symbol seen
-                                    # if output[-1] == ppt.end.label[-1]:
-                                    #     output = output[0]
-                                
-                            if ctype != "left":  
-                                output += "λ" # the lambda represents going into a state where you don't send a symbol to output tape  
-                                   
-                        # if the prefix transduction has already been made, dont let any more possible prefix transductions into transitions_to_add
-                        if ppt.is_transduction and not list(filter(lambda t: t.is_transduction, transitions_to_add)):
-                            continue
+                    # important line: when going to a right context state, we dont want to send the entire outsym to the output tape
+                    output = string_complement(outsym, end_label, pad="right")
+                    
+                    # checks to see if the prefix trans output also creates an environment for a transduction,
+                    # by looking up its proper suffixes (matches are applied in the order the environments were given)
+                    matches = sorted(match for i in range(1, len(outsym)) for match in envs.get(outsym[i:], ()))
+                    for _, out_mapping in matches:
+                        output = output[:-1] + out_mapping    
+                output += "λ"
+                    
+            # this block handles the transduction transition, i.e., whether the transduction should point to a prefix state, or q0      
+            if match.is_transduction and match.insym == last_seen_symbol:
+                is_transduction = True # setting this lets the already existing PH transduction get overwritten in make_delta()                           
+                output = match.outsym
+                
+                # transduction prefix transitions can get dicey. When ctype == right, need to subtract the end state from the output symbol
+                if ctype == "right":
+                    output = string_complement(match.outsym, end_label, pad="right") 
+                  
+                if ctype == "dual":
+                    if finals[end]:
+                        output = output[:-1]
                         
-                        transitions_to_add.append(Edge(ppt.start, last_seen_symbol, output, ppt.end, is_transduction=is_transduction))
-        
+                        #! possibly volatile conditional
+                        # edge case: self loop on transduction transition and last symbol of output matches the last symbol seen
+                        # if output[-1] == ppt.end.label[-1]:
+                        #     output = output[0]
+                    
+                if ctype != "left":  
+                    output += "λ" # the lambda represents going into a state where you don't send a symbol to output tape  
+            
+            transitions_to_add.append(start, last_seen_symbol, output, end, None, is_transduction, "", match.rule if is_transduction else None)
+    
     return transitions_to_add 
 
 
 
 def get_Q_sigma_gamma(trans):
     
-    Q = []
-    for t in trans:
-        if t.start not in Q:
-            Q.append(t.start)
+    trans = columns(trans)
+    Q = list(dict.fromkeys(trans.start)) # ordered set of start states
     
-    sigma = set(t.insym for t in trans)
-    gamma = set(t.outsym for t in trans) 
+    sigma = set(trans.insym)
+    gamma = set(trans.outsym) 
     return Q, sigma, gamma 
 
       
          
 def get_final_mappings(trans):
     
-    d = {State("λ"): ""}
-    for t in trans:
-        if t.start not in d and t.start.label != "λ":
-            if t.ctype == "left":
+    trans = columns(trans)
+    d = {LAMBDA: ""}
+    for start, ctype, seen_Lcon in zip(trans.start, trans.ctype, trans.seen_Lcon):
+        if start not in d:
+            if ctype == "left":
                 output = ""
             
-            elif t.ctype == "right":
-                output = t.start.label
+            elif ctype == "right":
+                output = start.label
 
-            elif t.ctype == "dual":
-                output = string_complement(t.start.label, t.seen_Lcon , pad="left")
+            elif ctype == "dual":
+                output = string_complement(start.label, seen_Lcon , pad="left")
             
-            d[t.start] = output
+            d[start] = output
     return d
 
 
 
-def get_transitions(insyms, outsyms, contexts=[], transduction_envs=[]):
+def rule_transitions(spec, edge_set=None):
+    """Generates the context transitions of a list of rules into a shared edge set. Rules are grouped by context, so
+    each context is walked once with all of its mappings, whatever order the rules are in
+    
+    Args:
+        spec (List[tuple]): (insym, outsym, context) rules, in the order of DFST.rules. Context free rules have a None context
+        edge_set (EdgeSet): edge set to add the transitions to
+    
+    Returns:
+        List[Edge]: context transitions
+    """
+    edge_set = EdgeSet() if edge_set is None else edge_set
     
-    context_trans = [] # list of all context transitions 
-    Lcons, Rcons, Dualcons= parse_contexts(contexts)
+    # context -> insyms, outsyms and rule indices of its mappings, in the order contexts first appear
+    groups = defaultdict(lambda: ([], [], []))
+    for i, (_in, _out, context) in enumerate(spec):
+        insyms, outsyms, rules = groups[context]
+        insyms.append(_in)
+        outsyms.append(_out)
+        rules.append(i)
+    
+    for context, (insyms, outsyms, rules) in groups.items():
+        if context is None:
+            cf_transitions(insyms, outsyms, edge_set=edge_set, rules=rules)
+            continue
+        
+        Lcons, Rcons, Dualcons = parse_contexts([context])
+        if Lcons:
+            Lcon_transitions(insyms, outsyms, Lcons, edge_set=edge_set, rules=rules)  
+        elif Rcons:
+            Rcon_transitions(insyms, outsyms, Rcons, edge_set=edge_set, rules=rules)  
+        else:
+            Dcon_transitions(insyms, outsyms, Dualcons, edge_set=edge_set, rules=rules)
+    return edge_set.edges
+
+
+
+def rule_spec(insyms, outsyms, contexts=[]):
+    """Expands mappings and contexts into the (insym, outsym, context) rules they stand for: every mapping in every context"""
     
     if not contexts:
-        context_trans += cf_transitions(insyms, outsyms)
-    if Lcons:
-        context_trans += Lcon_transitions(insyms, outsyms, Lcons)  
-    if Rcons:
-        context_trans += Rcon_transitions(insyms, outsyms, Rcons)  
-    if Dualcons:
-        context_trans += Dcon_transitions(insyms, outsyms, Dualcons)
+        return [(_in, _out, None) for _in, _out in zip(insyms, outsyms)]
+    return [(_in, _out, con) for con in contexts for _in, _out in zip(insyms, outsyms)]
+
+
+
+def get_transduction_envs(spec):
+    """Maps the environment each contextual rule transduces in (its context with the input symbol filled in) to its output"""
+    
+    transduction_envs = {}
+    for _in, _out, con in spec:
+        if con is not None:
+            transduction_envs[con.replace("_", _in).strip()] = _out
+    return transduction_envs
+
+
+
+def context_transitions(insyms, outsyms, contexts=[]):
+    
+    return rule_transitions(rule_spec(insyms, outsyms, contexts))
+
+
+
+def get_transitions(insyms=[], outsyms=[], contexts=[], transduction_envs=[], timings=None, spec=None):
     
-    all_trans = context_trans + prefix_transitions(context_trans, transduction_envs)
+    # spec (as returned by rule_spec) can be given instead of insyms, outsyms and contexts
+    start = time.perf_counter()
+    context_trans = rule_transitions(spec) if spec is not None else context_transitions(insyms, outsyms, contexts)
+    context_done = time.perf_counter()
+    all_trans = Edges(context_trans)
+    all_trans.extend(prefix_transitions(context_trans, transduction_envs))
     
+    # optionally record how long each phase took (in seconds)
+    if timings is not None:
+        timings["context_transitions"] = context_done - start
+        timings["prefix_transitions"] = time.perf_counter() - context_done
     return all_trans
 
     
     
+def get_rule_edges(trans, delta):
+    """Maps each (start state, insym) transition of delta that applies a rewrite rule to the index of that rule"""
+    
+    trans = columns(trans)
+    rule_edges = {}
+    for start, insym, outsym, end, rule in zip(trans.start, trans.insym, trans.outsym, trans.end, trans.rule):
+        if rule is not None and delta.get(start, {}).get(insym) == [outsym, end]:
+            rule_edges.setdefault((start, insym), rule)
+    return rule_edges
+
+
+
+def delta_row():
+    # module level (instead of a lambda) so that delta can be pickled
+    return defaultdict(dict)
+
+
+
 def get_delta(trans):
     
-    d = defaultdict(lambda: defaultdict(dict))
-    for tran in trans:
-        start, insym = tran.start, tran.insym
-        end, outsym = tran.end, tran.outsym 
+    trans = columns(trans)
+    d = defaultdict(delta_row)
+    for start, insym, outsym, end, is_transduction in zip(trans.start, trans.insym, trans.outsym, trans.end, trans.is_transduction):
+        row = d[start]
         
         # allows the PH transduction to be overwritten by the prefix one once
-        if not d[start][insym] or tran.is_transduction and d[start][insym][1] == State("λ"): 
-            d[start][insym] = [outsym, end] 
+        if not row[insym] or is_transduction and row[insym][1] is LAMBDA: 
+            row[insym] = [outsym, end] 
     return d
 
@@ -1,5 +1,7 @@
 #!/usr/bin/env python3
 
+import re
+
     
 class ContextError(Exception):
     pass
@@ -7,43 +9,62 @@ class ContextError(Exception):
 class RuleError(Exception):
     pass
 
+class StorageError(Exception):
+    pass
+
 
 PH = "?" 
+RESERVED = ["$", "λ", "Ø", "?"]
+STRIP_RESERVED = str.maketrans("", "", "".join(RESERVED)) # deletes every reserved symbol in one pass
 cfx = lambda string: f"<{string}>" 
 
+# a symbol is either a [tag] or a single non-whitespace character
+SYMBOL = re.compile(r"\[[^\]]*\]?|\S")
+
+# same as SYMBOL, but whitespace characters are symbols too
+CHARACTER = re.compile(r"\[[^\]]*\]?|.", re.DOTALL)
+
 def intersperse(string:str, delim=" "):
-    """This mess of a function intersperses a string with delim. Accounts for tag format as well: [XXX].
+    """Intersperses a string with delim. Accounts for tag format as well: [XXX].
 
     Args:
-        string (str): string to be delimited
+        string (str): string to be delimited. If a list of symbols is given instead, the symbols are joined
         delim (str, optional): delimiter. Defaults to " ".
 
     Returns:
         str: delimited string
     """
-    output = ""
+    # without tags, every character is a symbol
+    if "[" not in string:
+        return delim.join(string).strip(delim)
+    
+    if isinstance(string, str):
+        return delim.join(CHARACTER.findall(string)).strip(delim)
+    
+    # a "[" symbol still opens a tag that runs up to the next "]" symbol
+    symbols = []
     i = 0
-    while True:
-        try:
-            temp = string[i]
-        except IndexError:
-            break
-        
-        if temp == "[": # if "[" is detected, every symbol leading up to "]" is included in the tag
-            j = 0
-            for char in string[i+1:]:
-                j += 1
-                temp += char
-                if char == "]":
+    while i < len(string):
+        temp = string[i]
+        if temp == "[":
+            for sym in string[i+1:]:
+                i += 1
+                temp += sym
+                if sym == "]":
                     break
-            i += j # update i index to whatever is after the tag
-                    
-            output += delim + temp
-        else:     
-            output += delim + string[i]
+        symbols.append(temp)
         i += 1
-    
-    return output.strip(delim)
+    return delim.join(symbols).strip(delim)
+
+def split_symbols(string:str):
+    """Splits a string into symbols in one pass. Equivalent to intersperse(string).split() for strings without whitespace inside tags"""
+    return SYMBOL.findall(string)
+
+def read_lines(path, encoding="utf8"):
+    """Lazily yields the lines of a file without their trailing newline"""
+    with open(path, encoding=encoding) as f:
+        for line in f:
+            yield line.rstrip("\n")
 
 def despace(string):
     return "".join([c for c in string if c != " "])